@@ -0,0 +1,141 @@
+import os
+import stat
+import threading
+
+
+class FileIndex(object):
+    ''' An in-memory index of the files and folders under one or more root
+    folders, so that checking whether a lecture exists (or how big it is)
+    doesn't cost a round trip each time, which adds up on network mounted
+    storage. Each root is scanned once with scan(), then kept up to date by
+    calling refresh() / makedirs() for anything we write.
+    Paths outside the scanned roots go straight to the filesystem.
+    '''
+
+    def __init__(self):
+        self._roots = []
+        # Path -> (size, mtime) for files.
+        self._files = {}
+        # Path -> set of entry names for folders.
+        self._dirs = {}
+        self._lock = threading.RLock()
+
+    def scan(self, root):
+        root = os.path.abspath(root)
+        with self._lock:
+            self._scan_dir(root)
+            self._roots.append(root)
+
+    def _scan_dir(self, path):
+        entries = set()
+        self._dirs[path] = entries
+        try:
+            it = os.scandir(path)
+        except OSError:
+            return
+        with it:
+            for entry in it:
+                entries.add(entry.name)
+                try:
+                    if entry.is_dir():
+                        self._scan_dir(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        self._files[entry.path] = (st.st_size, st.st_mtime)
+                except OSError:
+                    continue
+
+    def _indexed(self, path):
+        return any(path == root or path.startswith(root + os.sep)
+                   for root in self._roots)
+
+    def isfile(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            if self._indexed(path):
+                return path in self._files
+        return os.path.isfile(path)
+
+    def isdir(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            if self._indexed(path):
+                return path in self._dirs
+        return os.path.isdir(path)
+
+    def stat(self, path):
+        ''' Returns (size, mtime) for a file, raising FileNotFoundError if it
+        doesn't exist.
+        '''
+        path = os.path.abspath(path)
+        with self._lock:
+            if self._indexed(path):
+                try:
+                    return self._files[path]
+                except KeyError:
+                    raise FileNotFoundError(path)
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+
+    def getsize(self, path):
+        return self.stat(path)[0]
+
+    def listdir(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            if self._indexed(path):
+                try:
+                    return sorted(self._dirs[path])
+                except KeyError:
+                    raise FileNotFoundError(path)
+        return os.listdir(path)
+
+    def makedirs(self, path):
+        path = os.path.abspath(path)
+        os.makedirs(path, exist_ok=True)
+        # Let the index know about every level we might have just created.
+        with self._lock:
+            created = []
+            while self._indexed(path) and path not in self._dirs:
+                created.append(path)
+                path = os.path.dirname(path)
+            for path in reversed(created):
+                self.refresh(path)
+
+    def add(self, path, size, mtime=None):
+        ''' Records a file that isn't on the local disk, such as a lecture in
+        remote storage (see storage.py), along with the folders it's in.
+        refresh() forgets it again, as it isn't on disk.
+        '''
+        path = os.path.abspath(path)
+        with self._lock:
+            if not self._indexed(path):
+                return
+            self._files[path] = (size, mtime)
+            while path not in self._roots:
+                parent, name = os.path.split(path)
+                self._dirs.setdefault(parent, set()).add(name)
+                path = parent
+
+    def refresh(self, path):
+        ''' Re-reads a single file or folder (not its contents) after it has
+        been created, written to or removed.
+        '''
+        path = os.path.abspath(path)
+        with self._lock:
+            if not self._indexed(path):
+                return
+            parent, name = os.path.split(path)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self._files.pop(path, None)
+                self._dirs.pop(path, None)
+                self._dirs.get(parent, set()).discard(name)
+                return
+            if path not in self._roots:
+                self._dirs.setdefault(parent, set()).add(name)
+            if stat.S_ISDIR(st.st_mode):
+                self._dirs.setdefault(path, set())
+            else:
+                self._files[path] = (st.st_size, st.st_mtime)
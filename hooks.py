@@ -0,0 +1,109 @@
+import json
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+
+from contextlib import suppress
+
+# What hooks are told about, see RunLog.
+HOOK_EVENTS = ('downloaded', 'failed', 'skipped')
+
+# Seconds to wait for a webhook to answer.
+WEBHOOK_TIMEOUT = 10
+# Seconds a command gets before it's stopped. Anything that takes longer
+# (like transcribing) should carry on in the background.
+COMMAND_TIMEOUT = 300
+# Seconds to wait for the hooks to catch up at the end of a run.
+CLOSE_TIMEOUT = 600
+
+
+def run_command(command, event, entry):
+    # The details go in the environment for simple scripts, and as JSON on
+    # stdin for everything else.
+    env = dict(os.environ,
+               LECTUREDL_EVENT=event,
+               LECTUREDL_NAME=entry.get('name') or '',
+               LECTUREDL_PATH=entry.get('path') or '',
+               LECTUREDL_SUBJECT=entry.get('subject') or '',
+               LECTUREDL_REASON=entry.get('reason') or '')
+    # In a session of its own, so that everything it starts can be stopped.
+    with subprocess.Popen(command, shell=True, env=env, stdin=subprocess.PIPE,
+                          start_new_session=True) as process:
+        try:
+            process.communicate(json.dumps(entry).encode(),
+                                timeout=COMMAND_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            with suppress(AttributeError, OSError):
+                os.killpg(process.pid, signal.SIGKILL)
+            process.kill()
+            process.wait()
+            raise RuntimeError(f'took longer than {COMMAND_TIMEOUT}s')
+    if process.returncode != 0:
+        raise RuntimeError(f'exited with {process.returncode}')
+
+
+def post_webhook(url, event, entry):
+    # urllib is slow to import, so only do so if there's a webhook.
+    import urllib.request
+    req = urllib.request.Request(url, data=json.dumps(entry).encode(),
+                                 headers={'Content-Type': 'application/json',
+                                          'X-LectureDL-Event': event})
+    urllib.request.urlopen(req, timeout=WEBHOOK_TIMEOUT).close()
+
+
+class HookDispatcher(object):
+    ''' Tells hooks about each lecture that is downloaded, fails or is
+    skipped, e.g. to start transcribing it as soon as it lands. A hook is
+    either a function (called with the event and a dict describing the
+    lecture), a URL (the dict is POSTed to it as JSON) or a shell command.
+    Hooks are run one at a time, in order, on a thread of their own, so a
+    slow hook never holds up the downloads. A hook that fails is reported
+    and the rest carry on.
+    '''
+
+    def __init__(self, hooks):
+        self.hooks = list(hooks)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def fire(self, event, entry):
+        self._queue.put((event, entry))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            event, entry = item
+            for hook in self.hooks:
+                try:
+                    self._call(hook, event, entry)
+                except Exception as e:
+                    print(f'Hook {getattr(hook, "__name__", hook)} failed on '
+                          f'{entry.get("name")}: {e}', file=sys.stderr)
+
+    def _call(self, hook, event, entry):
+        entry = dict(entry, event=event)
+        if callable(hook):
+            hook(event, entry)
+        elif hook.startswith(('http://', 'https://')):
+            post_webhook(hook, event, entry)
+        else:
+            run_command(hook, event, entry)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        ''' Waits (up to timeout seconds) for the hooks to catch up. '''
+        waiting = self._queue.qsize()
+        if waiting:
+            print(f'Waiting for hooks to finish with {waiting} lecture(s)...')
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f'Gave up waiting for the hooks after {timeout}s, '
+                  f'{max(0, self._queue.qsize() - 1)} lecture(s) weren\'t '
+                  f'passed on.',
+                  file=sys.stderr)
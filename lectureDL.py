@@ -60,47 +60,74 @@
 # Shorten Scrolling Function (Line 561 in download_lectures_for_subject())
 
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import (
-    NoSuchElementException,
-    ElementNotVisibleException,
-    StaleElementReferenceException,
-    WebDriverException,
-)
+import time
 
+# Everything after this counts towards the startup time, see STARTUP_BUDGET.
+STARTUP_START = time.perf_counter()
+
+import argparse
 import datetime
 import functools
 import getpass
+import json
 import os
 import os.path
 import random
 import re
+import shutil
 import sys
-import time
-import urllib
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 from contextlib import suppress
-from queue import Queue
+from fileindex import FileIndex
+from hooks import HookDispatcher
+from linkcache import LinkCache, LinkExpiredError, link_expired
+from manifest import Manifest
+from naming import (
+    DEFAULT_ARCHIVE_TEMPLATE,
+    DEFAULT_EXTENSIONS,
+    DEFAULT_NAME_TEMPLATE,
+    NameFunction,
+    NameTemplate,
+)
+from runlog import RunLog
+from storage import LocalStorage, S3Storage
+from semesters import (
+    current_period,
+    DEFAULT_TEACHING_PERIODS,
+    find_period,
+)
+from scheduler import (
+    assign_shard,
+    DiskSpaceAdmission,
+    DownloadPlan,
+    DownloadScheduler,
+)
 from threading import Thread
 from util import (
+    CircuitBreaker,
+    cookie_jar,
+    drop_expired_cookies,
+    load_cookies,
     retry_until_result,
+    RetryPolicy,
+    save_cookies,
     show_progress,
     StdoutSpace,
+    write_private_json,
 )
 
-# To revert to regular stdout, just comment out this line.
-# The file=sys.__stdout__ part in util.show_progress could then also be removed.
-sys.stdout = StdoutSpace(sys.stdout)
+# Selenium and urllib are slow to import and only needed by the commands that
+# crawl or download, so they are imported by load_browser_stack() and
+# load_network_stack() when those commands start, not here.
+webdriver = Options = Keys = None
+NoSuchElementException = ElementNotVisibleException = None
+StaleElementReferenceException = WebDriverException = None
+http = urllib = None
 
 # Try to read in a settings file.
 try:
-    from settings import (
-        settings,
-        getLectureName,
-    )
+    from settings import settings
 except ImportError as e:
     print(f'Couldn\'t import a settings file: {str(e)}')
     settings = defaultdict(lambda: None, {
@@ -110,8 +137,29 @@ except ImportError as e:
         'auto_create_subfolders': True,
         'default_auto_create_format': '{code} - {name}',
         'driver_relative_path': 'chromedriver',
+        'download_order': 'newest',
+        'max_retries': 5,
+        'circuit_breaker_threshold': 5,
+        'circuit_breaker_cooldown': 60,
+        'lean_crawl': True,
+        'browser_profile_dir': 'chrome_profile',
+        'session_file': '.lectureDL_session.json',
+        'manifest_name': '.lectureDL_manifest.json',
+        'preallocate': True,
+        'free_space_reserve_mb': 500,
+        'disk_space_wait': 300,
+        'max_queued_downloads': 100,
+        'run_log': 'lectureDL_run.jsonl',
+        'teaching_periods': DEFAULT_TEACHING_PERIODS,
+        'download_threads': 1,
+        'lecture_name_template': DEFAULT_NAME_TEMPLATE,
+        'archive_name_template': DEFAULT_ARCHIVE_TEMPLATE,
+        'media_extensions': DEFAULT_EXTENSIONS,
+        'hooks': [],
+        'bulk_scrape': True,
+        'storage': None,
+        'media_link_ttl': 3600,
     })
-    getLectureName = lambda lec: f'{lec.subjCode} Week {lec.week:02} Lecture {lec.lecOfWeek}'
     print('Will download to ' + str(settings['uni_location']))
     print('Will automatically create the subject folders.')
     print('Default folder and lecture names will be used.')
@@ -134,11 +182,115 @@ FOLDER_NAME_ERROR = ("No folder with the code subject_code in its name was",
                      "'auto_create_subfolders' setting set to True in the",
                      "settings file.")
 
+# How lecture files are named, parsed once here. See naming.py.
+try:
+    LECTURE_NAME = NameTemplate(settings['lecture_name_template']
+                                or DEFAULT_NAME_TEMPLATE)
+    ARCHIVE_NAME = NameTemplate(settings['archive_name_template']
+                                or DEFAULT_ARCHIVE_TEMPLATE)
+except ValueError as e:
+    print(f'Check the name templates in your settings: {e}', file=sys.stderr)
+    sys.exit(1)
+# Older settings files name lectures with a function instead. The one in
+# settings_base is only there so their imports keep working, it's the same
+# as the default template. Earlier periods still go by the archive template.
+with suppress(ImportError):
+    from settings import getLectureName
+    from settings_base import getLectureName as default_lecture_name
+    if getLectureName is not default_lecture_name:
+        LECTURE_NAME = NameFunction(getLectureName)
+MEDIA_EXTENSIONS = settings['media_extensions'] or DEFAULT_EXTENSIONS
+
 GET_ECHO = 'Getting past intermediate page / waiting for Echocenter to load...'
 NO_DL_FOLDER = 'The downloads folder doesn\'t exist either, shutting down.'
 
+LMS_URL = "https://app.lms.unimelb.edu.au"
+
+# Requests Chrome doesn't bother making in lean crawl mode. We only need the
+# text and links on each page, so fonts, media and trackers are dead weight.
+LEAN_CRAWL_BLOCKED_URLS = [
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.ico', '*.webp',
+    '*.mp4', '*.m4v', '*.mp3', '*.m4a', '*.webm',
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*',
+    '*facebook.net*', '*hotjar.com*', '*newrelic.com*', '*nr-data.net*',
+]
+
+# Seconds to wait on a stalled connection before treating it as dropped.
+NETWORK_TIMEOUT = 60
+# Errors worth retrying a network operation for, set by load_network_stack().
+NETWORK_ERRORS = None
+
+# Commands that don't touch the browser or network should start within this
+# many seconds, run with --timing to check.
+STARTUP_BUDGET = 0.2
+
+# Network operations back off for longer, and stop trying a media server
+# altogether for a while if it keeps failing. See util.RetryPolicy.
+network_retry = RetryPolicy(
+    settings.get('max_retries', 5), base_delay=1, max_delay=30,
+    breaker=CircuitBreaker(settings.get('circuit_breaker_threshold', 5),
+                           settings.get('circuit_breaker_cooldown', 60)))
+browser_retry = RetryPolicy(settings.get('max_retries', 5), base_delay=0.5,
+                            max_delay=8)
+
+
+def load_network_stack():
+    global http, urllib, NETWORK_ERRORS
+    import http.client
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+    NETWORK_ERRORS = (OSError, http.client.HTTPException)
+
+
+def load_browser_stack():
+    global webdriver, Options, Keys, NoSuchElementException
+    global ElementNotVisibleException, StaleElementReferenceException
+    global WebDriverException
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.keys import Keys
+    from selenium.common.exceptions import (
+        NoSuchElementException,
+        ElementNotVisibleException,
+        StaleElementReferenceException,
+        WebDriverException,
+    )
+
+
+# All existence and size checks under the uni folder go through this, so
+# that it is only listed once per run rather than stat'ed per lecture.
+# main() scans the uni folder into it, see fileindex.py.
+file_index = FileIndex()
+
+# What we know about each recording from previous runs, such as its size on
+# the server. main() loads this from the uni folder, see manifest.py.
+manifest = Manifest()
+
+# The media link each lecture page resolves to, kept in the manifest until
+# it expires. See linkcache.py.
+link_cache = LinkCache(manifest, settings.get('media_link_ttl', 3600))
+
+# Where lectures are saved, see open_storage() and storage.py. Until then,
+# the local disk.
+storage = LocalStorage(file_index, settings.get('preallocate', True))
+
+# Set by main() when run with --profile, see profiling.py.
+profiler = None
+
+
+def is_permanent_http_error(e):
+    # Client errors won't fix themselves, except timeouts and rate limiting.
+    return (isinstance(e, urllib.error.HTTPError) and 400 <= e.code < 500
+            and e.code not in (408, 429))
+
 
 class Subject(object):
+    # There can be a lot of these (and Lectures) on a big backfill.
+    __slots__ = ('code', 'name', 'link', 'num', 'path', 'downloaded',
+                 'listed')
+
     def __init__(self, code, name, link, num, path=None, downloaded=0):
         self.code = code
         self.name = name
@@ -146,14 +298,21 @@ class Subject(object):
         self.num = num
         self.path = path
         self.downloaded = downloaded
+        # When we last went through every one of its recordings, if we have.
+        self.listed = None
 
     def __str__(self):
         return f"{self.code} - {self.name}"
 
 
 class Lecture(object):
+    __slots__ = ('link', 'subjCode', 'week', 'lecOfWeek', 'date', 'subjName',
+                 'recNum', 'folder', 'fName', 'fPath', 'dl_status', 'period',
+                 'layout')
+
     def __init__(self, link, subjCode, week, lecOfWeek, date, subjName,
-                 recNum, folder, fName=None, fPath=None, dl_status=None):
+                 recNum, folder, fName=None, fPath=None, dl_status=None,
+                 period=None, layout=None):
         self.link = link
         self.subjCode = subjCode
         self.week = week
@@ -165,6 +324,10 @@ class Lecture(object):
         self.fName = fName
         self.fPath = fPath
         self.dl_status = dl_status
+        # The teaching period it was recorded in, e.g. '2017 SM2'.
+        self.period = period
+        # Which name template it goes by, see lecture_layout.
+        self.layout = layout
 
     def __str__(self):
         strFormat = f"{self.subjCode} {self.subjName} - Week {self.week}"
@@ -187,15 +350,15 @@ def check_uni_folder(uni_folder, home_dir):
     return uni_folder
 
 
-def getSubjectFolder(subject_code, uni_folder):
-    ''' Enables any subject_code in which the subject code is included to be
+def getSubjectFolder(subject, uni_folder):
+    ''' Enables any folder in which the subject code is included to be
         identified as the appropriate folder for the subject.
     '''
-    print(f"Retrieving folder with name that includes: {subject_code}")
+    print(f"Retrieving folder with name that includes: {subject.code}")
 
     # Using the subject code to find the appropriate folder.
-    for fold in os.listdir(uni_folder):
-        if subject_code.lower() in fold.lower():
+    for fold in file_index.listdir(uni_folder):
+        if subject.code.lower() in fold.lower():
             subjectFolder = fold
             break
     try:
@@ -208,8 +371,9 @@ def getSubjectFolder(subject_code, uni_folder):
         if settings['auto_create_subfolders']:
             subjectFolder = settings['default_auto_create_format'].format(
                 code=subject.code, name=subject.name)
-            os.mkdir(os.path.join(uni_folder, subjectFolder))
+            file_index.makedirs(os.path.join(uni_folder, subjectFolder))
             print('Made folder: ' + subjectFolder)
+            return subjectFolder
 
         # Print an error.
         else:
@@ -257,33 +421,20 @@ def get_download_mode():
 
 # if user enters comma-separated weeks, make a list for each and then
 # concatenate
-def get_weeks_to_download(current_year, week_day):
+def get_weeks_to_download(period):
+    ''' Works out which dates of the given teaching period (see semesters.py)
+    to download lectures for, from the settings or by asking.
+    '''
     # TODO break up this god awful huge function.
-    # build week number dictionary
-    current_date = datetime.datetime(current_year, 7, 24)
     today = datetime.datetime.today()
     today_midnight = datetime.datetime(today.year, today.month, today.day)
-    # This is O-Week, so the start of week 1 should be 7 days after this.
-    start_week0 = datetime.datetime(current_year, 7, 17)
-    end_week0 = datetime.datetime(current_year, 7, 23)
-    day_delta = datetime.timedelta(days=1)
     week_delta = datetime.timedelta(days=7)
-    weeks_in_semester = 12
-    week_counter = 1
-    day_counter = 1
-    midsemBreakWeek = 9  # Mid sem break occurs after this week.
-
-    # assigns a week number to each date.
-    while week_counter <= weeks_in_semester:
-        while day_counter <= 7:
-            week_day[current_date] = week_counter
-            day_counter += 1
-            current_date = current_date + day_delta
-        week_counter += 1
-        # If we enter the week of the midsem break, skip a week.
-        if week_counter == midsemBreakWeek + 1:
-            current_date = current_date + week_delta
-        day_counter = 1
+    # This is O-Week, so the start of week 1 should be 7 days after this.
+    start_week0 = period.start - week_delta
+    end_week0 = start_week0 + datetime.timedelta(days=6)
+    weeks_in_semester = period.weeks
+    # Mid sem break occurs after this week.
+    midsemBreakWeek = period.break_after or weeks_in_semester
 
     current_week_no_offset = (datetime.datetime.today() - start_week0).days // 7
     midsem_offset = (current_week_no_offset+1) // midsemBreakWeek
@@ -309,7 +460,7 @@ def get_weeks_to_download(current_year, week_day):
                 print("Using", settings['date_range'])
             else:
                 print("Downloading lectures from every week.")
-                settings['date_range'] = '1-{weeks_in_semester}'  # TODO This is a hack.
+                settings['date_range'] = f'1-{weeks_in_semester}'  # TODO This is a hack.
             user_dates_input = settings['date_range']
         dates_list = []
 
@@ -359,6 +510,32 @@ def get_weeks_to_download(current_year, week_day):
     return dates_list
 
 
+def is_signed_in(driver):
+    # If there is no login form we must still be signed in from last time.
+    return not driver.find_elements_by_css_selector("input[name=user_id]")
+
+
+def restore_session(driver):
+    ''' Adds the cookies saved from the last run to the browser, which must
+    already be on the LMS. Returns True if there were any to add.
+    '''
+    if not settings['session_file']:
+        return False
+    cookies = load_cookies(settings['session_file'])
+    for cookie in cookies:
+        # Chrome only accepts whole seconds here.
+        if 'expiry' in cookie:
+            cookie['expiry'] = int(cookie['expiry'])
+        with suppress(WebDriverException):
+            driver.add_cookie(cookie)
+    return bool(cookies)
+
+
+def save_session(driver):
+    if settings['session_file']:
+        save_cookies(settings['session_file'], driver.get_cookies())
+
+
 def sign_in(driver):
     user_field = driver.find_element_by_css_selector("input[name=user_id]")
     if settings['username'] is None:
@@ -484,7 +661,62 @@ def determine_subjects_to_download(subject_list):
     return getSubjects(subject_list)
 
 
-def download_lecture(dl_link, output_name, pretty_name, sizeLocal):
+def download_lecture(dl_link, output_name, pretty_name, sizeLocal,
+                     page=None):
+    ''' Downloads dl_link to output_name, starting from byte sizeLocal.
+    If the connection fails partway through we back off and resume from the
+    last byte written, see network_retry. If the link has expired and we
+    know which lecture page it came from, we get a fresh one from there.
+    '''
+    # Fresh downloads go to a preallocated part file where we can, picking up
+    # from wherever a previous run got to (see util.PartFile), or straight to
+    # remote storage (see storage.S3Upload).
+    part = storage.part(output_name, sizeLocal)
+    if part is not None:
+        sizeLocal = part.written
+    start = sizeLocal
+    refreshed = False
+
+    def attempt():
+        nonlocal start, dl_link, refreshed
+        try:
+            download_lecture_once(dl_link, output_name, pretty_name, start,
+                                  part)
+        except NETWORK_ERRORS as e:
+            if page is None or refreshed or not link_expired(e):
+                raise
+            dl_link = refresh_link(page, e)
+            refreshed = True
+            raise LinkExpiredError(f'The link for {pretty_name} had expired, '
+                                   f'trying again with a new one')
+        finally:
+            # Whatever happened, pick up from where the file got to.
+            if part is not None:
+                start = part.written
+            else:
+                with suppress(OSError):
+                    start = os.path.getsize(output_name)
+
+    first = start
+    try:
+        network_retry.call(attempt, f'Downloading {pretty_name}',
+                           exceptions=NETWORK_ERRORS,
+                           host=urllib.parse.urlparse(dl_link).netloc,
+                           giveup=is_permanent_http_error)
+    except BaseException:
+        if part is not None:
+            # Don't let a failure to clean up hide why the download failed.
+            with suppress(Exception):
+                part.abort()
+        raise
+    finally:
+        storage.refresh(output_name)
+    if profiler is not None:
+        profiler.count(bytes=file_index.getsize(output_name) - first)
+
+
+def download_lecture_once(dl_link, output_name, pretty_name, sizeLocal,
+                          part=None):
     partial = bool(sizeLocal)
     req = urllib.request.Request(dl_link)
     if not partial:
@@ -494,7 +726,12 @@ def download_lecture(dl_link, output_name, pretty_name, sizeLocal):
         # Resuming a partially completed download.
         req.headers['Range'] = 'bytes=%s-' % sizeLocal
         mode = 'ab'
-    f = urllib.request.urlopen(req)
+    f = urllib.request.urlopen(req, timeout=NETWORK_TIMEOUT)
+    if partial and f.status != 206:
+        # The server ignored the range and is sending the whole file.
+        mode = 'wb'
+        partial = False
+        sizeLocal = 0
     # We do + sizeLocal because if we are doing a partial download, the length
     # is only for what we requested to download, not the whole thing.
     sizeWeb = int(f.headers["Content-Length"]) + sizeLocal
@@ -505,12 +742,84 @@ def download_lecture(dl_link, output_name, pretty_name, sizeLocal):
         print(f"Resuming partial download of {pretty_name} ({sizeLocal/1000:0.1f}/{sizeWeb/1000:0.1f}).")
 
     # The ab is the append write mode.
-    with open(output_name, mode) as output:
+    if part is not None:
+        output = part.open(sizeLocal, sizeWeb)
+    else:
+        output = open(output_name, mode)
+    with output:
         for chunk in show_progress(f, pretty_name, sizeLocal, sizeWeb):
             # Process the chunk
             output.write(chunk)
     f.close()
 
+    # A connection that gets closed early just looks like the end of the file.
+    if part is not None:
+        sizeNow = part.written
+    else:
+        sizeNow = os.path.getsize(output_name)
+    if sizeNow < sizeWeb:
+        raise ConnectionError(f'Connection closed after {sizeNow} of '
+                              f'{sizeWeb} bytes')
+    if part is not None:
+        part.finish()
+
+
+def get_remote_size(dl_link, page=None):
+    ''' Returns the size in bytes the server advertises for dl_link, or 0 if
+    it doesn't advertise one. Expired links are refreshed from page, like in
+    download_lecture.
+    '''
+    refreshed = False
+
+    def probe():
+        nonlocal dl_link, refreshed
+        try:
+            f = urllib.request.urlopen(dl_link, timeout=NETWORK_TIMEOUT)
+        except NETWORK_ERRORS as e:
+            if page is None or refreshed or not link_expired(e):
+                raise
+            dl_link = refresh_link(page, e)
+            refreshed = True
+            raise LinkExpiredError('The link had expired, trying again with '
+                                   'a new one')
+        f.close()
+        # This is the size of the file on the server in bytes.
+        return int(f.headers["Content-Length"])
+
+    try:
+        return network_retry.call(probe, 'Checking size of download',
+                                  exceptions=NETWORK_ERRORS,
+                                  host=urllib.parse.urlparse(dl_link).netloc,
+                                  giveup=is_permanent_http_error)
+    except Exception:
+        # Catching the situation where the server doesn't advertise the file length.
+        return 0
+
+
+def refresh_link(page, error):
+    ''' Gets a fresh media link for page (see LinkCache.refresh), or
+    re-raises error if we can't.
+    '''
+    print(f"Link from {page} has expired, getting a new one")
+    try:
+        return link_cache.refresh(page)
+    except (ValueError,) + NETWORK_ERRORS as e:
+        print(f"Couldn't get a new link from {page}: {e}", file=sys.stderr)
+        raise error
+
+
+def get_lecture_size(lec, dl_link):
+    ''' Like get_remote_size, but remembers the answer in the manifest so we
+    only have to ask the server once per lecture.
+    '''
+    entry = manifest.get(lec.link)
+    if entry and entry.get('size'):
+        return entry['size']
+    size = get_remote_size(dl_link, lec.link)
+    if size:
+        manifest.update(lec.link, size=size)
+    return size
+
 
 def getToRecordingsFirstPage(driver):
     recs_first_page = search_link_text(driver, LECTURE_TAB_STRINGS)
@@ -526,16 +835,21 @@ def getToRecordingsFirstPage(driver):
     recs_first_page.click()
 
 
+def enterEchoFrames(driver):
+    # The list of recordings is nested a few iframes deep.
+    with suppress(Exception):
+        iframe = driver.find_elements_by_tag_name('iframe')[1]
+        driver.switch_to_frame(iframe)
+        iframe = driver.find_elements_by_tag_name('iframe')[0]
+        driver.switch_to_frame(iframe)
+        iframe = driver.find_elements_by_tag_name('iframe')[0]
+        driver.switch_to_frame(iframe)
+
+
 # @retry_until_result('Waiting for the echocenter to load... ')
 def getLectureList(driver):
     try:
-        with suppress(Exception):
-            iframe = driver.find_elements_by_tag_name('iframe')[1]
-            driver.switch_to_frame(iframe)
-            iframe = driver.find_elements_by_tag_name('iframe')[0]
-            driver.switch_to_frame(iframe)
-            iframe = driver.find_elements_by_tag_name('iframe')[0]
-            driver.switch_to_frame(iframe)
+        enterEchoFrames(driver)
         recs_ul = driver.find_element_by_css_selector("ul#echoes-list")
         recs_list = recs_ul.find_elements_by_css_selector("li.li-echoes")
     except NoSuchElementException:
@@ -564,145 +878,453 @@ def getToEchoCenter(driver):
     return getLectureList(driver)
 
 
-def assign_filepaths(lectures, download_mode, uni_folder):
-    '''Assign filepaths (and therefore also file names) to lectures.
+def assign_filepath(lec, download_mode, uni_folder):
+    '''Assign a filepath (and therefore also a file name) to a lecture.
 
     Args:
-        lectures (list): List of lecture objects
+        lec (Lecture): The lecture object
         download_mode (str): A string specifying audio ('audio') or video
                              ('video') downloads.
 
     Returns:
-        lectures (list): The list of lecture objects, with filepaths added.
+        lec (Lecture): The lecture object, with its filepath added.
     '''
-    # Get the filepaths and file names
-    for lec in lectures:
-        filename = getLectureName(lec)
+    name, file_path, lec.layout = lecture_path(lec, download_mode,
+                                               uni_folder)
 
-        # Adjust name for audio files
-        if download_mode == 'audio':
-            filename_with_ext = filename + '.mp3'
-        else:
-            filename_with_ext = filename + '.m4v'
-        file_path = os.path.join(uni_folder, lec.folder, LECTURE_FOLDER_NAME,
-                                 filename_with_ext)
-
-        # Create the directory if it doesn't already exist.
-        if not os.path.isdir(os.path.join(uni_folder, lec.folder,
-                                          LECTURE_FOLDER_NAME)):
-            print(f'Making {LECTURE_FOLDER_NAME} folder for {lec.folder}')
-            os.makedirs(os.path.join(folder, lec.folder,
-                                     LECTURE_FOLDER_NAME))
-        lec.fName = filename
-        lec.fPath = file_path
-
-    return lectures
-
-
-def download_lectures_for_subject(driver, subject, current_year, week_day,
-                                  dates_list, download_mode, uni_folder, q):
-    downloaded = []
-    skipped = []
-    print(f"\nNow working on {subject.code}: {subject.name}")
+    # Create the directory if it doesn't already exist.
+    lecture_folder = os.path.dirname(file_path)
+    if not file_index.isdir(lecture_folder):
+        print(f'Making {os.path.relpath(lecture_folder, uni_folder)} folder')
+        file_index.makedirs(lecture_folder)
+    lec.fName = os.path.basename(name)
+    lec.fPath = file_path
 
-    # Go to subject page and find Lecture Recordings page.
-    driver.get(subject.link)
-    main_window = driver.current_window_handle
+    return lec
 
-    # Get to the list of lectures.
-    getToRecordingsFirstPage(driver)
-    try:
-        recs_ul, recs_list = getToEchoCenter(driver)
-    except RuntimeError:
-        # TODO Make this error catching more specific.
-        print(f'NOTE! The echocenter could not be found for {subject.name}! Moving on...')
+
+def lecture_path(lec, download_mode, uni_folder):
+    ''' Returns (name, path, layout) for a lecture according to the name
+    templates, where name may include subfolders but not the extension, and
+    layout says which template was used (see lecture_layout).
+    '''
+    layout = lecture_layout(lec, download_mode, uni_folder)
+    return render_path(lec, layout, download_mode, uni_folder) + (layout,)
+
+
+def render_path(lec, layout, download_mode, uni_folder):
+    name = (LECTURE_NAME if layout == 'current' else ARCHIVE_NAME).render(lec)
+    file_path = os.path.join(uni_folder, lec.folder, LECTURE_FOLDER_NAME,
+                             name + MEDIA_EXTENSIONS[download_mode])
+    return name, file_path
+
+
+def lecture_layout(lec, download_mode, uni_folder):
+    ''' Returns which name template a lecture goes by, 'current' or
+    'archive'. Lectures from earlier teaching periods are named differently
+    (by default they get a folder of their own) so their week numbers don't
+    clash with this period's. But a recording keeps the layout it was saved
+    under, so lectures don't move when their period ends, only when the
+    template itself changes.
+    '''
+    entry = manifest.get(lec.link)
+    if entry and entry.get('layout'):
+        return entry['layout']
+    # Saved before we remembered the layout, see if the path gives it away.
+    if entry and entry.get('path'):
+        for layout in ('current', 'archive'):
+            _, path = render_path(lec, layout, download_mode, uni_folder)
+            if path == entry['path']:
+                return layout
+    current = current_period(datetime.datetime.today(),
+                             settings['teaching_periods'])
+    if lec.period is None or lec.period == str(current):
+        return 'current'
+    return 'archive'
+
+
+def follow_rename(lec, log):
+    ''' If the manifest says we saved this lecture somewhere else (because
+    the naming convention has changed), moves it to its new path rather than
+    downloading it all over again. If something else is already there, the
+    lecture stays where it was. Returns None if there's nowhere for it to go
+    (a new lecture whose path belongs to another recording).
+    '''
+    entry = manifest.get(lec.link)
+    old_path = entry and entry.get('path')
+    if old_path == lec.fPath:
+        return lec
+    owner = manifest.find('path', lec.fPath)
+    if old_path is None:
+        if owner is None:
+            return lec
+        lec.dl_status = (f"{lec.fPath} is already another recording's, "
+                         f"check your name templates")
+        log.record('skipped', lec)
+        print(f"NOTE! Skipping {lec.fName}: {lec.dl_status}")
         return None
+    if owner is not None or path_taken(lec.fPath):
+        print(f"NOTE! Couldn't rename {old_path} to {lec.fPath}, something "
+              f"else is already there. Check your name templates.")
+        lec.fPath = old_path
+        lec.fName = entry.get('name') or os.path.splitext(
+            os.path.basename(old_path))[0]
+        return lec
+    move_lecture(old_path, lec.fPath)
+    return lec
 
-    # setup for recordings
-    multiple_lectures = False
-    lectures_list = []
-    to_download = []
 
-    # Getting the subject folder in which to put the lecture.
-    subjectFolder = getSubjectFolder(subject.code, uni_folder)
+def path_taken(path):
+    return file_index.isfile(path) or file_index.isfile(path + '.part')
 
-    # print status
-    print("Building list of lectures...")
-    # for each li element, build up filename info and add to download list
-    for rec_num, recording in enumerate(recs_list):
-        # click on each recording to get different download links
-        date_div = recording.find_element_by_css_selector("div.echo-date")
-
-        # Deals with error where the next element can't be selected if it isn't
-        # literally visible. Limitation of selenium. Scrolls down to adjust.
-        while True:
-            try:
-                # Prevent header from hiding list
-                driver.execute_script(f"arguments[0].focus();", recs_ul)
-                driver.execute_script(f"window.scrollTo(0, 15);")
-                recording.click()
-                break
-            # Scroll down to element
-            except ElementNotVisibleException:
-                actions = webdriver.ActionChains(driver)
-                actions.move_to_element(recording)
-                actions.click()
-                actions.perform()
 
-        # convert string into datetime.datetime object
-        # date is formatted like "August 02 3:20 PM" but I want "August 02 2016"
-        # so I need to get rid of time and add year
-        date_string = " ".join(date_div.text.split(" ")[:-2]) + f" {current_year}"
+def move_lecture(old_path, new_path):
+    ''' Moves whatever we have of a lecture from old_path to new_path.
+    Returns whether there was anything to move. Nothing is moved if there's
+    already something at new_path.
+    '''
+    # Don't clobber anything that's already there.
+    if path_taken(new_path):
+        return False
+    # A download that's still in progress moves along with its progress.
+    moved = False
+    for suffix in ('', '.part', '.part.json'):
+        if not file_index.isfile(old_path + suffix):
+            continue
+        storage.move(old_path + suffix, new_path + suffix)
+        moved = True
+    if moved:
+        print(f"Renamed {old_path} to {new_path}")
+    return moved
+
+
+def remember_lecture(lec, **fields):
+    # Workers don't know the layout, they go by the path they were given.
+    if lec.layout is not None:
+        fields['layout'] = lec.layout
+    manifest.update(lec.link, subject=lec.subjCode, subject_name=lec.subjName,
+                    date=lec.date.strftime('%Y-%m-%d'), week=lec.week,
+                    lecture=lec.lecOfWeek, recording=lec.recNum,
+                    period=lec.period, name=lec.fName, path=lec.fPath,
+                    **fields)
+    return lec
+
+
+def mark_removed(subject):
+    ''' Marks the recordings we know of for subject that weren't listed when
+    we last went through all of its recordings as removed from the LMS. The
+    sync command can then prune them.
+    '''
+    for link, entry in manifest.entries().items():
+        if (entry.get('listing') == subject.link and not entry.get('removed')
+                and entry.get('seen', 0) < subject.listed):
+            print(f"{entry.get('name')} is no longer on the LMS")
+            manifest.update(link, removed=time.time())
+
+
+def number_week(week_lectures):
+    ''' Numbers the lectures of a single week. They come in newest first, but
+    the oldest lecture of the week is Lecture 1.
+    '''
+    for i, lec in enumerate(week_lectures):
+        lec.lecOfWeek = len(week_lectures) - i
+        # Recordings we couldn't get a link for still count, so that the
+        # others keep their numbers (and names), but go no further.
+        if lec.link is not None:
+            yield lec
+
+
+def parse_recording_date(text, year):
+    ''' Turns a date from the recordings list into a datetime in the given
+    year, or the latest year before it that has that day (for February 29).
+    '''
+    # date is formatted like "August 02 3:20 PM" but I want "August 02", and
+    # it's parsed in a leap year so that February 29 is allowed.
+    date_string = " ".join(text.split(" ")[:-2]) + " 2000"
+    try:
+        date = datetime.datetime.strptime(date_string, "%d %B %Y")
+    except ValueError:
+        # Sometimes the date is presented in different format.
+        date = datetime.datetime.strptime(date_string, "%B %d %Y")
+    while True:
         try:
-            date = datetime.datetime.strptime(date_string, "%d %B %Y")
+            return date.replace(year=year)
         except ValueError:
-            # Sometimes the date is presented in different format.
-            date = datetime.datetime.strptime(date_string, "%B %d %Y")
+            year -= 1
+
+
+# Reads the date of every recording in the list in one go.
+LIST_RECORDINGS_JS = '''
+return Array.prototype.map.call(
+    document.querySelectorAll('ul#echoes-list li.li-echoes'),
+    function (li) {
+        var date = li.querySelector('div.echo-date');
+        return date ? date.textContent.replace(/\\s+/g, ' ').trim() : null;
+    });
+'''
+
+# Clicks on each of the given recordings in turn, and reads the link to its
+# download page once the page has caught up, all in one round trip. Recordings it
+# couldn't get a link for (in timeout ms) are left as null.
+FIRST_LINKS_JS = '''
+var indices = arguments[0], linkText = arguments[1], timeout = arguments[2];
+var done = arguments[arguments.length - 1];
+var items = document.querySelectorAll('ul#echoes-list li.li-echoes');
+var links = {};
+function currentLink() {
+    var anchors = document.getElementsByTagName('a');
+    for (var i = 0; i < anchors.length; i++) {
+        if (anchors[i].textContent.indexOf(linkText) !== -1) {
+            return anchors[i].href;
+        }
+    }
+    return null;
+}
+function next(n, previous) {
+    if (n >= indices.length) {
+        done(links);
+        return;
+    }
+    var started = Date.now();
+    items[indices[n]].scrollIntoView();
+    items[indices[n]].click();
+    (function poll() {
+        var link = currentLink();
+        if (link && link !== previous) {
+            links[indices[n]] = link;
+            next(n + 1, link);
+        } else if (Date.now() - started > timeout) {
+            links[indices[n]] = null;
+            next(n + 1, previous);
+        } else {
+            setTimeout(poll, 50);
+        }
+    })();
+}
+next(0, currentLink());
+'''
+
+# How long the page gets to show each recording's link in FIRST_LINKS_JS.
+BULK_LINK_TIMEOUT = 5
+# How many recordings FIRST_LINKS_JS is given at a time.
+BULK_LINK_BATCH = 10
+
+
+def recording_dates(driver, recs_list):
+    ''' Returns the date text of each recording, newest first, with a single
+    round trip to the browser if we can.
+    '''
+    if settings.get('bulk_scrape', True):
+        with suppress(WebDriverException):
+            texts = driver.execute_script(LIST_RECORDINGS_JS)
+            if len(texts) == len(recs_list) and all(texts):
+                return texts
+    return [recording.find_element_by_css_selector("div.echo-date").text
+            for recording in recs_list]
+
+
+def click_for_first_link(driver, recs_ul, recording, download_mode):
+    # Deals with error where the next element can't be selected if it isn't
+    # literally visible. Limitation of selenium. Scrolls down to adjust.
+    def click_recording():
+        try:
+            # Prevent header from hiding list
+            driver.execute_script(f"arguments[0].focus();", recs_ul)
+            driver.execute_script(f"window.scrollTo(0, 15);")
+            recording.click()
+        # Scroll down to element, then try again.
+        except ElementNotVisibleException:
+            actions = webdriver.ActionChains(driver)
+            actions.move_to_element(recording)
+            actions.click()
+            actions.perform()
+            raise
+
+    # get link to initial download page for either audio or video
+    def find_first_link():
+        if download_mode == "audio":
+            return driver.find_element_by_partial_link_text("Audio File").get_attribute("href")
+        return driver.find_element_by_partial_link_text("Video File").get_attribute("href")
+
+    browser_retry.call(click_recording, 'Clicking on recording',
+                       exceptions=(WebDriverException,))
+    return browser_retry.call(find_first_link, 'Finding download page',
+                              exceptions=(WebDriverException,))
+
+
+def find_first_links(driver, recs_ul, recs_list, rec_nums, download_mode):
+    ''' Yields (rec_num, link) for each of rec_nums (indexes into recs_list),
+    where link is the recording's download page, or None if we couldn't find
+    it. The links are read BULK_LINK_BATCH at a time if we can (see
+    FIRST_LINKS_JS), so the first ones can be on their way while we read the
+    rest. Otherwise we click through the recordings one by one.
+    '''
+    bulk = settings.get('bulk_scrape', True)
+    link_text = "Audio File" if download_mode == "audio" else "Video File"
+    seen = set()
+    for start in range(0, len(rec_nums), BULK_LINK_BATCH):
+        batch = rec_nums[start:start + BULK_LINK_BATCH]
+        links = {}
+        if bulk:
+            try:
+                driver.set_script_timeout(len(batch) * BULK_LINK_TIMEOUT + 30)
+                found = driver.execute_async_script(FIRST_LINKS_JS, batch,
+                                                    link_text,
+                                                    BULK_LINK_TIMEOUT * 1000)
+                links = {int(rec_num): link for rec_num, link in found.items()}
+            except WebDriverException as e:
+                print(f'Couldn\'t read the recordings in one go, clicking '
+                      f'through the rest of them instead: {e}',
+                      file=sys.stderr)
+                bulk = False
+        for rec_num in batch:
+            link = links.get(rec_num)
+            # If the page was slow to catch up, we might have been given the
+            # link of the recording before. Click on those (and any we
+            # missed) again.
+            if link is None or link in seen:
+                try:
+                    link = click_for_first_link(driver, recs_ul,
+                                                recs_list[rec_num],
+                                                download_mode)
+                except WebDriverException as e:
+                    print(f'NOTE! Couldn\'t find the download page for '
+                          f'recording {rec_num + 1}, skipping it: {e}',
+                          file=sys.stderr)
+                    link = None
+            seen.add(link)
+            yield rec_num, link
+
+
+def enumerate_lectures(driver, subject, subjectFolder, recs_ul, recs_list,
+                       dates_list, download_mode):
+    ''' Goes through the list of recordings, yielding a Lecture for each
+    one as soon as it can be numbered. If dates_list is None every recording
+    is included, whichever teaching period it's from.
+
+    The recordings are listed newest first, so we hold on to the lectures of
+    each week until a recording from an earlier week turns up. At that point
+    the week is complete and its lectures can be numbered and sent on, rather
+    than waiting for the whole list to be gone through.
+    '''
+    pending = defaultdict(list)
+    # Whether we've been through every recording, see mark_removed.
+    listing_started = time.time()
+    complete = True
+
+    # The dates on the page don't say which year they're from. Since they're
+    # newest first, we start from this year and go back a year every time
+    # the dates jump forwards.
+    today = datetime.datetime.today()
+    year = today.year
+    previous_date = today
+    # Work out which recordings we want from their dates before clicking on
+    # any of them.
+    wanted = []
+    for rec_num, date_text in enumerate(recording_dates(driver, recs_list)):
+        # convert string into datetime.datetime object
+        date = parse_recording_date(date_text, year)
+        if date > previous_date:
+            year -= 1
+            date = parse_recording_date(date_text, year)
+        year = date.year
+        previous_date = date
 
         # Checking if we can terminate early.
-        if date < dates_list[0]:
+        if dates_list is not None and date < dates_list[0]:
             print("The lectures further down are outside the date range, no need to check them.")
+            complete = False
             break
 
-        # lookup week number and set default lecture number
-        try:
-            week_num = week_day[date]
-        except KeyError:
+        # lookup teaching period and week number
+        period, week_num = find_period(date, settings['teaching_periods'])
+        if period is None:
             print('NOTE! Ignoring lecture with date ' + str(date) + ' because\n'
-                  '      it is outside of the standard semester week range,\n'
-                  '      you\'ll have to download it manually :/')
+                  '      it is outside of the teaching weeks of any semester\n'
+                  '      (see teaching_periods in the settings), you\'ll\n'
+                  '      have to download it manually :/')
             continue
-        lec_num = 1
-
-        # get link to initial download page for either audio or video
-        while True:
-            try:
-                if download_mode == "audio":
-                    first_link = driver.find_element_by_partial_link_text("Audio File").get_attribute("href")
-                else:
-                    first_link = driver.find_element_by_partial_link_text("Video File").get_attribute("href")
-                break
-            except NoSuchElementException:
-                time.sleep(0.5)
-
-        # check if week_num is already in to_download
-        for lecture in lectures_list:
-            if lecture.week == week_num:
-                # set multiple_lectures to true so filenames include lec nums
-                multiple_lectures = True
-                # add 1 to lec_num of earlier video
-                lecture.lecOfWeek += 1
-
-        # Create Lecture
-        lectures_list.append(Lecture(first_link, subject.code, week_num,
-                                     lec_num, date, subject.name,
-                                     len(recs_list) - rec_num, subjectFolder))
-
-    # assign filepaths, filenames
-    lectures_list = assign_filepaths(lectures_list, download_mode, uni_folder)
+        wanted.append((rec_num, date, period, week_num))
+
+    first_links = find_first_links(driver, recs_ul, recs_list,
+                                   [rec_num for rec_num, *_ in wanted],
+                                   download_mode)
+    for (rec_num, date, period, week_num), (_, first_link) in zip(wanted,
+                                                                  first_links):
+        if first_link is None:
+            complete = False
+        # Weeks are only in order within a teaching period.
+        week_key = (period.start, week_num)
+
+        # Any later weeks we're still holding on to are now complete.
+        for week in sorted([w for w in pending if w > week_key], reverse=True):
+            yield from number_week(pending.pop(week))
+
+        # Create Lecture, it gets its lecture number once its week is complete.
+        # One without a link is only there to be counted, see number_week.
+        pending[week_key].append(Lecture(first_link, subject.code, week_num,
+                                         None, date, subject.name,
+                                         len(recs_list) - rec_num,
+                                         subjectFolder, period=str(period)))
+
+    # Send on whatever is left.
+    for week in sorted(pending, reverse=True):
+        yield from number_week(pending.pop(week))
+    if complete:
+        subject.listed = listing_started
+
+
+def open_link_window(driver):
+    ''' Opens a second window to resolve download links in, so that the list
+    of recordings in the main window stays put while we do so.
+    Returns the handle of the new window.
+    '''
+    existing = set(driver.window_handles)
+    driver.execute_script("window.open('');")
+    return (set(driver.window_handles) - existing).pop()
 
-    # DOWNLOADING STARTS HERE
 
+def get_download_link(driver, lec, link_window, main_window):
+    ''' Resolves the actual media file link for a lecture in the link window,
+    then goes back to the list of recordings in the main window.
+    '''
+    # go to initial download page and find actual download link
+    def resolve():
+        driver.get(lec.link)
+        dl_link = driver.find_element_by_partial_link_text("Download media file.").get_attribute("href")
+        # send javascript to stop download redirect
+        driver.execute_script('stopCounting=true')
+        return dl_link
+
+    driver.switch_to_window(link_window)
+    try:
+        dl_link = browser_retry.call(resolve, f'Getting link for {lec.fName}',
+                                     exceptions=(WebDriverException,))
+        # So links that expire can be refreshed without the browser.
+        if link_cache.cookies is None:
+            link_cache.cookies = driver.get_cookies()
+        # Kept so the download, later runs and sync can use it without
+        # coming back here.
+        return link_cache.put(lec.link, dl_link)
+    finally:
+        driver.switch_to_window(main_window)
+        enterEchoFrames(driver)
+
+
+def resolve_download_link(driver, lec, link_window, main_window):
+    # The browser only has to go to the lecture page if we don't have a
+    # link for it that's still good, see linkcache.py.
+    return (link_cache.get(lec.link) or
+            get_download_link(driver, lec, link_window, main_window))
+
+
+def classify_lectures(driver, lectures, dates_list, log, link_window,
+                      main_window):
+    ''' Yields (lecture, partial) for each lecture that needs downloading,
+    where partial is False for a fresh download or (sizeLocal, sizeWeb) for
+    an incomplete one. Lectures that don't need downloading are logged as
+    skipped, those we couldn't check as failed.
+    '''
     # TODO - This is going into each link even if we don't need the lecture.
     #        This slows the program down massively.
     #        Perhaps filter out those with invalid dates & non-existent files?
@@ -711,52 +1333,53 @@ def download_lectures_for_subject(driver, subject, current_year, week_day,
     #        don't have to do this every time.
     # only add lectures to be downloaded if they are inside date range. else,
     # skip them
-    for lec in lectures_list:
+    for lec in lectures:
+        in_range = dates_list is None or lec.date in dates_list
+        exists = file_index.isfile(lec.fPath)
 
-        # Append to download list if the file in date range and doesn't exist yet.
-        if lec.date in dates_list and not os.path.isfile(lec.fPath):
+        # Download if the file in date range and doesn't exist yet.
+        if in_range and not exists:
             print(f"Will download {lec.fName}")
-            to_download.append((lec, False)) # False means not downloaded at all.
+            yield lec, False  # False means not downloaded at all.
 
         # If the file is in the range but does exist, check that the file is completely
-        # downloaded. If not, we will add it to the download list and overwrite the
-        # local incomplete version.
+        # downloaded. If not, we will download it and append to the local
+        # incomplete version.
 
         # DAVETODO: SAVE FILE SIZES AND COMPLETED DOWNLOADS IN PICKLE FILE
         # DAVETODO: CREATE SETTING 're-download' WHICH MAKES THE PROGRAM CHECK
         #           WHETHER OR NOT OLD FILES STILL EXIST, AND REDOWNLOAD IF
         #           NECESSARY.
 
-        elif lec.date in dates_list and os.path.isfile(lec.fPath):
-            while True:
-                try:
-                    driver.get(lec.link)
-                    dl_link = driver.find_element_by_partial_link_text("Download media file.").get_attribute("href")
-                    # send javascript to stop download redirect
-                    driver.execute_script('stopCounting=true')
-                    break
-                except:
-                    time.sleep(0.5)
+        elif in_range and exists:
+            # Get size of file on disk.
+            sizeLocal = file_index.getsize(lec.fPath)
+
+            # If we know how big it is from last time we can tell it's
+            # complete without going back to the server.
+            entry = manifest.get(lec.link)
+            if entry and entry.get('size') and sizeLocal >= entry['size']:
+                lec.dl_status = "File already exists on disk (fully downloaded)."
+                log.record('skipped', lec)
+                print("Skipping " + lec.fName + ": " + lec.dl_status)
+                continue
+
+            try:
+                dl_link = resolve_download_link(driver, lec, link_window,
+                                            main_window)
+            except WebDriverException as e:
+                report_failure(lec, log, f'Couldn\'t get download link: {e}')
+                continue
             # Check size of file on server. If the server version is larger than the local version,
             # we notify the user of an incomplete file (perhaps the connection dropped or the user
             # cancelled the download). We tell them we're going to download it again.
             # Using wget we could resume the download, but python urllib doesn't have such functionality.
-            try:
-                # TODO: This whole thing is weird, we shouldn't have to open the
-                # web link twice. This should all probably be handled in the
-                # download function, or at least more elegantly than this.
-                f = urllib.request.urlopen(dl_link)
-                # This is the size of the file on the server in bytes.
-                sizeWeb = int(f.headers["Content-Length"])
-            except:
-                # Catching the situation where the server doesn't advertise the file length.
-                sizeWeb = 0
-
-            # Get size of file on disk.
-            statinfo = os.stat(lec.fPath)
-            sizeLocal = statinfo.st_size
+            # TODO: This whole thing is weird, we shouldn't have to open the
+            # web link twice. This should all probably be handled in the
+            # download function, or at least more elegantly than this.
+            sizeWeb = get_lecture_size(lec, dl_link)
 
-            # Add to download list with note that it was incomplete.
+            # Download with note that it was incomplete.
             # TODO Unify the two bits of code to do with downloading / progress.
             # BUG: Fully downloaded lectures are re-downloading?
             if sizeWeb > sizeLocal:
@@ -764,98 +1387,440 @@ def download_lectures_for_subject(driver, subject, current_year, week_day,
                     sizeLocal / 1024 / 1024,
                     sizeWeb / 1024 / 1024,
                 )
-                # Include (sizeLocal, sizeWeb) if partially downloaded.
-                to_download.append((lec, (sizeLocal, sizeWeb)))
                 print("Resuming " + lec.fName + ": " + lec.dl_status)
+                # Include (sizeLocal, sizeWeb) if partially downloaded.
+                yield lec, (sizeLocal, sizeWeb)
             # Otherwise the file must be fully downloaded.
             else:
                 lec.dl_status = "File already exists on disk (fully downloaded)."
-                skipped.append(lec)
+                log.record('skipped', lec)
                 print("Skipping " + lec.fName + ": " + lec.dl_status)
 
         # Dealing with other cases.
         else:
             # if both outside date range and already exists
-            if not lec.date in dates_list and os.path.isfile(lec.fPath):
+            if not in_range and exists:
                 lec.dl_status = "Outside date range and file already exists"
             # if just outside date range
-            elif not lec.date in dates_list:
+            elif not in_range:
                 lec.dl_status = "Outside date range"
             # If file already exists and is fully completed.
             # Shouldn't really get to this case (caught above).
-            elif os.path.isfile(lec.fPath):
+            elif exists:
                 lec.dl_status = "File already exists"
-            skipped.append(lec)
+            log.record('skipped', lec)
             print(f"Skipping {lec.fName}: {lec.dl_status}")
 
-    # print list of lectures to be downloaded
-    if len(to_download) > 0:
-        print("Lectures to be downloaded:")
-        for lec, partial in to_download:
-            # Print with additional note if it's there.
-            # DAVE_HERE
-            if lec.dl_status is not None:
-                print(lec.fName, "-", lec.dl_status)
-            else:
-                print(lec.fName)
-    else:
-        print("No lectures to be downloaded for " + subject.name)
 
-    # for each lecture, set filename and download
+def download_lectures_for_subject(driver, subject, dates_list, download_mode,
+                                  uni_folder, q, log):
+    queued = 0
+    print(f"\nNow working on {subject.code}: {subject.name}")
+
+    # Go to subject page and find Lecture Recordings page.
+    driver.get(subject.link)
+    main_window = driver.current_window_handle
+
+    # Get to the list of lectures.
+    getToRecordingsFirstPage(driver)
+    try:
+        recs_ul, recs_list = getToEchoCenter(driver)
+    except RuntimeError:
+        # TODO Make this error catching more specific.
+        print(f'NOTE! The echocenter could not be found for {subject.name}! Moving on...')
+        return
+
+    # Getting the subject folder in which to put the lecture.
+    subjectFolder = getSubjectFolder(subject, uni_folder)
+
+    # Download links are resolved in a separate window so we don't lose our
+    # place in the list of recordings.
+    link_window = open_link_window(driver)
+
+    # print status
+    print("Building list of lectures...")
+    # Each recording flows through the whole pipeline (numbering, naming,
+    # filtering, link resolution, queueing) as soon as it has been clicked on,
+    # so downloads start while we're still working through the list.
+    lectures = enumerate_lectures(driver, subject, subjectFolder, recs_ul,
+                                  recs_list, dates_list, download_mode)
+    lectures = (assign_filepath(lec, download_mode, uni_folder)
+                for lec in lectures)
+    lectures = (follow_rename(lec, log) for lec in lectures)
+    lectures = (lec for lec in lectures if lec is not None)
+    lectures = (remember_lecture(lec, media=download_mode,
+                                 listing=subject.link, seen=time.time(),
+                                 removed=None)
+                for lec in lectures)
+    to_download = classify_lectures(driver, lectures, dates_list, log,
+                                    link_window, main_window)
+
+    # DOWNLOADING STARTS HERE
     for lec, partial in to_download:
 
-        # build up filename
         print("Now working on", lec.fName)
-        # go to initial download page and find actual download link
-        while True:
-            try:
-                driver.get(lec.link)
-                dl_link = driver.find_element_by_partial_link_text("Download media file.").get_attribute("href")
-                # send javascript to stop download redirect
-                driver.execute_script('stopCounting=true')
-                break
-            except:
-                time.sleep(0.5)
+        try:
+            dl_link = resolve_download_link(driver, lec, link_window,
+                                            main_window)
+        except WebDriverException as e:
+            report_failure(lec, log, f'Couldn\'t get download link: {e}')
+            continue
 
         # This handles a full download. Report the local size as 0.
         if not partial:
-            dl_func = functools.partial(download_lecture, dl_link, lec.fPath, lec.fName, 0)
+            dl_func = functools.partial(download_lecture, dl_link, lec.fPath, lec.fName, 0,
+                                        page=lec.link)
+            # Only probe the size if the download order depends on it.
+            size = None
+            if q.needs_sizes:
+                size = get_lecture_size(lec, dl_link) or None
         # This handles a partially downloaded file.
         else:
             sizeLocal, sizeWeb = partial
-            dl_func = functools.partial(download_lecture, dl_link, lec.fPath, lec.fName, sizeLocal)
+            dl_func = functools.partial(download_lecture, dl_link, lec.fPath, lec.fName, sizeLocal,
+                                        page=lec.link)
+            size = sizeWeb - sizeLocal
+
+        # This waits if the download thread is too far behind.
+        q.put(dl_func, lec, size)
+        log.record('queued', lec)
+        queued += 1
+        # Print with additional note if it's there.
+        if lec.dl_status is not None:
+            print("Queued", lec.fName, "-", lec.dl_status)
+        else:
+            print("Queued", lec.fName)
 
-        q.put(dl_func)
-        downloaded.append(lec)
+    # Done with the link window.
+    driver.switch_to_window(link_window)
+    driver.close()
+    driver.switch_to_window(main_window)
+
+    if not queued:
+        print("No lectures to be downloaded for " + subject.name)
+    if subject.listed is not None:
+        mark_removed(subject)
+    manifest.save()
 
     # when finished with subject
     print(f"Queued downloads for {subject.code}! Going to next file!")
-    return downloaded, skipped
+
 
 # Check dates_list
 # The lectures further down are outside the date range, no need to check them.
 
-def consume_dl_queue(q):
+def report_failure(lec, log, reason):
+    lec.dl_status = reason
+    log.record('failed', lec)
+    print(f"Failed {lec.fName}: {reason}", file=sys.stderr)
+
+
+def consume_dl_queue(q, log):
     # This will just keep consuming an item from the queue and downloading it
-    # until the program ends. get() blocks if there isn't an item in the queue.
+    # until the queue is closed. get() blocks if there isn't an item in the
+    # queue, and returns None once it has been closed and emptied.
     while True:
-        dl_func = q.get()
-        res = dl_func()
-        if res is False:
+        job = q.get()
+        if job is None:
             break
+        if job.rejected:
+            report_failure(job.lecture, log, job.rejected)
+            continue
+        # A failed download (after retries) is reported against its lecture,
+        # it mustn't take the rest of the queue down with it.
+        try:
+            job.dl_func()
+        except Exception as e:
+            report_failure(job.lecture, log, f'Download failed: {e}')
+            if profiler is not None:
+                profiler.count(failed=1)
+        else:
+            if profiler is not None:
+                profiler.count(lectures=1)
+            manifest.update(job.lecture.link, downloaded=time.time())
+            # Save as we go, so a long run can pick up where it left off.
+            # If we can't (e.g. the disk is full), the downloads carry on
+            # and the next save has another go.
+            try:
+                manifest.save()
+            except OSError as e:
+                print(f"Couldn't save the manifest: {e}", file=sys.stderr)
+            log.record('downloaded', job.lecture)
+        finally:
+            q.done(job)
+
+
+def start_downloaders(q, log):
+    # Several downloads can run at once, see the download_threads setting.
+    threads = []
+    for i in range(max(1, settings.get('download_threads', 1))):
+        name = f'download-{i + 1}'
+        t = Thread(target=profiled(name, consume_dl_queue), args=(q, log),
+                   name=name, daemon=True)
+        t.start()
+        threads.append(t)
+    return threads
+
+
+def profiled(name, function):
+    # Profiles function as the thread name when run with --profile.
+    if profiler is None:
+        return function
+    return profiler.wrap(name, function)
+
+
+def start_hooks():
+    # Hooks are told about each lecture as the download threads finish with
+    # it, see hooks.py. No hooks, no thread.
+    if not settings['hooks']:
+        return None
+    return HookDispatcher(settings['hooks'])
+
+
+def make_scheduler(uni_folder):
+    # Downloads are handed out in the order given by the download_order
+    # setting rather than the order they were found in, and only once there
+    # is room for them on disk. See scheduler.py.
+    # Remote storage doesn't need any room on disk.
+    admission = None
+    if storage.local:
+        reserve = settings.get('free_space_reserve_mb', 500) * 1024 * 1024
+        admission = DiskSpaceAdmission(uni_folder, reserve)
+    # The queue is bounded so the crawler can't get too far ahead of the
+    # downloads on a big backfill.
+    return DownloadScheduler(settings['download_order'] or 'crawl', admission,
+                             settings.get('disk_space_wait', 300),
+                             settings.get('max_queued_downloads', 100))
+
+
+def get_chrome_options():
+    chrome_options = Options()
+    window_size = settings.get('window_size', '1600,900')
+    chrome_options.add_argument('--window-size=' + window_size)
+    if settings['hide_window']:
+        print('Running in headless (hidden window) mode.')
+        chrome_options.add_argument('--headless')
+        chrome_options.add_argument('--disable-gpu')  # TODO: Remove this
+    # Reusing a profile keeps cached static files and cookies between runs.
+    if settings['browser_profile_dir']:
+        profile_dir = os.path.abspath(settings['browser_profile_dir'])
+        chrome_options.add_argument('--user-data-dir=' + profile_dir)
+    if settings['lean_crawl']:
+        print('Running in lean crawl mode (no images, fonts or media).')
+        chrome_options.add_argument('--autoplay-policy=user-gesture-required')
+        chrome_options.add_argument('--mute-audio')
+        chrome_options.add_experimental_option('prefs', {
+            'profile.managed_default_content_settings.images': 2,
+            'profile.managed_default_content_settings.media_stream': 2,
+            'profile.managed_default_content_settings.plugins': 2,
+            'profile.managed_default_content_settings.notifications': 2,
+        })
+    return chrome_options
+
+
+def block_urls(driver, patterns):
+    ''' Stops Chrome from making requests matching any of the wildcard
+    patterns, using the DevTools protocol.
+    '''
+    # Older versions of selenium don't expose DevTools commands directly.
+    if not hasattr(driver, 'execute_cdp_cmd'):
+        driver.command_executor._commands['send_command'] = (
+            'POST', '/session/$sessionId/chromium/send_command')
+        driver.execute_cdp_cmd = lambda cmd, params: driver.execute(
+            'send_command', {'cmd': cmd, 'params': params})
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': patterns})
+    except WebDriverException as e:
+        print(f'Couldn\'t block requests, lean crawl will be less lean: {e}',
+              file=sys.stderr)
+
+
+def print_status(uni_folder):
+    ''' Lists how many lectures have been downloaded for each subject, without
+    starting the browser.
+    '''
+    open_storage(uni_folder)
+    total = 0
+    for fold in file_index.listdir(uni_folder):
+        lecture_folder = os.path.join(uni_folder, fold, LECTURE_FOLDER_NAME)
+        if not file_index.isdir(lecture_folder):
+            continue
+        # Leave out downloads that are still in progress, see util.PartFile.
+        paths = [os.path.join(lecture_folder, name)
+                 for name in file_index.listdir(lecture_folder)
+                 if not name.endswith(('.part', '.part.json'))]
+        size = sum(file_index.getsize(p) for p in paths
+                   if file_index.isfile(p))
+        total += size
+        print(f"{fold}: {len(paths)} lecture(s), {size / 1024**3:0.2f} GiB")
+    print(f"Total: {total / 1024**3:0.2f} GiB in {storage}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Downloads lecture recordings from the Unimelb LMS. '
+                    'Settings are read from settings.py.')
+    parser.add_argument('--timing', action='store_true',
+                        help='print how long startup took')
+    parser.add_argument('--profile', nargs='?', const='lectureDL_profile',
+                        metavar='DIR',
+                        help='profile the crawl and each download thread, '
+                             'writing the results to DIR (default '
+                             'lectureDL_profile)')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.add_parser('download', help='download new lectures (default)')
+    commands.add_parser('archive', help='download every recording that is '
+                                        'still up, from every semester')
+    commands.add_parser('status', help='show what has been downloaded so '
+                                       'far, without starting the browser')
+    plan_parser = commands.add_parser(
+        'plan', help='work out what would be downloaded and how big it is, '
+                     'without downloading anything')
+    plan_parser.add_argument('-o', '--output', default='lectureDL_plan.json',
+                             help='where to write the plan (JSON)')
+    export_parser = commands.add_parser(
+        'export', help='like plan, but also include the session cookies so '
+                       'the downloads can be done elsewhere with worker')
+    export_parser.add_argument('-o', '--output', default='lectureDL_jobs.json',
+                               help='where to write the jobs (JSON)')
+    worker_parser = commands.add_parser(
+        'worker', help='download (a share of) the jobs from a plan or '
+                       'export, without starting the browser')
+    worker_parser.add_argument('jobs', help='the file written by export')
+    worker_parser.add_argument('--shard', default='1/1', type=parse_shard,
+                               help='which share of the jobs to download, '
+                                    'e.g. 2/3 for the second of three '
+                                    'workers (default 1/1)')
+    worker_parser.add_argument('--dest', help='uni folder to download into '
+                                              '(default uni_location)')
+    sync_parser = commands.add_parser(
+        'sync', help='rename, download or delete lectures to match what we '
+                     'found on the LMS last time, without starting the '
+                     'browser')
+    sync_parser.add_argument('--prune', action='store_true',
+                             help='delete lectures that have been taken off '
+                                  'the LMS')
+    sync_parser.add_argument('-n', '--dry-run', action='store_true',
+                             help='only say what would be done')
+    return parser.parse_args()
+
+
+def parse_shard(text):
+    try:
+        shard, num_shards = (int(x) for x in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('should look like 2/3')
+    if not 1 <= shard <= num_shards:
+        raise argparse.ArgumentTypeError(f'there is no shard {text}')
+    return shard, num_shards
 
 
 def main():
+    global profiler
+    args = parse_args()
+    if args.timing:
+        startup = time.perf_counter() - STARTUP_START
+        print(f"Started up in {startup * 1000:0.0f}ms (budget "
+              f"{STARTUP_BUDGET * 1000:0.0f}ms)", file=sys.stderr)
+        if startup > STARTUP_BUDGET:
+            print("Startup is over budget, check for slow imports with "
+                  "python -X importtime", file=sys.stderr)
+
+    if args.profile:
+        # Only imported when needed, see STARTUP_BUDGET.
+        from profiling import ThreadProfiler
+        profiler = ThreadProfiler()
+        profiler.start()
+    try:
+        dispatch(args)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.profile)
+            print(f"Wrote profiles to {args.profile}", file=sys.stderr)
+
+
+def dispatch(args):
+    if args.command == 'status':
+        if not os.path.isdir(settings['uni_location']):
+            print(f"{settings['uni_location']} doesn't exist.",
+                  file=sys.stderr)
+            sys.exit(1)
+        print_status(settings['uni_location'])
+    elif args.command == 'plan':
+        plan(args.output)
+    elif args.command == 'export':
+        plan(args.output, export=True)
+    elif args.command == 'worker':
+        work(args.jobs, *args.shard, args.dest)
+    elif args.command == 'archive':
+        download(archive=True)
+    elif args.command == 'sync':
+        sync(args.prune, args.dry_run)
+    else:
+        download()
+
+
+def setup_uni_folder(uni_folder=None):
+    # To revert to regular stdout, just comment out this line.
+    # The file=sys.__stdout__ part in util.show_progress could then also be removed.
+    sys.stdout = StdoutSpace(sys.stdout)
+
     # Setup download folders
     home_dir = os.path.expanduser("~")
-    uni_folder = check_uni_folder(settings['uni_location'], home_dir)
+    uni_folder = check_uni_folder(uni_folder or settings['uni_location'],
+                                  home_dir)
+    open_storage(uni_folder)
+    manifest.load(os.path.join(uni_folder, settings['manifest_name']))
+    return uni_folder
 
+
+def open_storage(uni_folder):
+    ''' Sets up where lectures are saved (see the storage setting) and indexes
+    what's already there.
+    '''
+    global storage
+    config = dict(settings['storage'] or {'type': 'local'})
+    kind = config.pop('type', 'local')
+    if kind == 's3':
+        load_network_stack()
+        try:
+            storage = S3Storage(file_index, retry=network_retry,
+                                giveup=is_permanent_http_error, **config)
+        except TypeError as e:
+            print(f"The storage setting isn't right: {e}", file=sys.stderr)
+            sys.exit(1)
+    elif kind != 'local':
+        print(f"Unknown storage type {kind}, choose from: local, s3",
+              file=sys.stderr)
+        sys.exit(1)
+    try:
+        storage.scan(uni_folder)
+    except NETWORK_ERRORS as e:
+        print(f"Couldn't list the lectures in {storage}: {e}",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+def crawl(q, uni_folder, log, cookies=None, archive=False):
+    ''' Goes through the LMS and puts every lecture that needs downloading on
+    q, writing down what happened to each lecture in log. Returns how long
+    each subject took to crawl. If cookies is given, the browser's cookies
+    are added to it before it is closed. If archive is True every recording
+    is downloaded, from every teaching period, rather than asking which weeks.
+    '''
     print("Welcome to", sys.argv[0])
 
     # Date Junk
-    current_year = datetime.datetime.now().year
-    week_day = {}
-    dates_list = get_weeks_to_download(current_year, week_day)
+    if archive:
+        print("Archive mode, downloading every recording that's still up.")
+        dates_list = None
+    else:
+        period = current_period(datetime.datetime.today(),
+                                settings['teaching_periods'])
+        print(f"Downloading from {period}")
+        dates_list = get_weeks_to_download(period)
     # DATE ERROR
     # print(dates_list)
 
@@ -863,13 +1828,9 @@ def main():
 
     # Start Chrome instance
     print("Starting up Chrome instance")
-    chrome_options = Options()
-    window_size = settings.get('window_size', '1600,900')
-    chrome_options.add_argument('--window-size=' + window_size)
-    if settings['hide_window']:
-        print('Running in headless (hidden window) mode.')
-        chrome_options.add_argument('--headless')
-        chrome_options.add_argument('--disable-gpu')  # TODO: Remove this
+    load_network_stack()
+    load_browser_stack()
+    chrome_options = get_chrome_options()
     try:
         # We build an absolute path to avoid the "Message: 'chromedriver'
         # executable needs to be in PATH" error.
@@ -884,12 +1845,21 @@ def main():
             print(str(e1), file=sys.stderr)
             print(str(e2), file=sys.stderr)
             sys.exit(1)
-
-    # Login
-    print("Starting login process")
-    driver.get("https://app.lms.unimelb.edu.au")
-    sign_in(driver)
-    driver.refresh()
+    if settings['lean_crawl']:
+        block_urls(driver, LEAN_CRAWL_BLOCKED_URLS)
+
+    # Login, unless the browser profile or saved session cookies mean we're
+    # still signed in from last time.
+    driver.get(LMS_URL)
+    if not is_signed_in(driver) and restore_session(driver):
+        driver.refresh()
+    if is_signed_in(driver):
+        print("Still signed in from last time, skipping login")
+    else:
+        print("Starting login process")
+        sign_in(driver)
+        driver.refresh()
+        save_session(driver)
     print("Building list of subjects")
 
     # This yucky looking control structure makes sure we get the right
@@ -915,42 +1885,324 @@ def main():
     for subject in subjects_to_download:
         print(f"{subject.code}: {subject.name}")
 
-    # Track which lectures we downloaded and which we skipped.
-    all_downloaded = []
-    all_skipped = []
-
-    q = Queue()
-    t = Thread(target=consume_dl_queue, args=(q,), daemon=True)
-    t.start()
+    # How long crawling each subject took, to see what lean crawl buys us.
+    crawl_times = []
     for subject in subjects_to_download:
-        res = download_lectures_for_subject(driver, subject, current_year,
-                                            week_day, dates_list,
-                                            download_mode, uni_folder, q)
-        if res:
-            downloaded, skipped = res
-            all_downloaded += downloaded
-            all_skipped += skipped
+        crawl_start = time.monotonic()
+        queued = log.counts['queued']
+        download_lectures_for_subject(driver, subject, dates_list,
+                                      download_mode, uni_folder, q, log)
+        if profiler is not None:
+            profiler.count(subjects=1, lectures=log.counts['queued'] - queued)
+        crawl_times.append((subject, time.monotonic() - crawl_start))
+        print(f"Crawled {subject.code} in {crawl_times[-1][1]:.1f}s")
     # Done , close the browser.
-    print("All links have been collected, waiting for downloads to complete...")
+    if cookies is not None:
+        cookies += driver.get_cookies()
     driver.quit()
-    # Let the thread know that we're done collecting download links.
-    q.put(lambda: False)
+    return crawl_times
+
+
+def run_downloads(uni_folder, queue_jobs):
+    ''' Starts the download threads, has queue_jobs(q, log) queue up the
+    lectures for them, then waits for them all to finish and says how it
+    went. Returns whatever queue_jobs did.
+    '''
+    # This is written to by the download threads as well.
+    log = RunLog(settings['run_log'], start_hooks())
+    q = make_scheduler(uni_folder)
+    threads = start_downloaders(q, log)
+    result = queue_jobs(q, log)
+    # Let the threads know that there's nothing more coming.
+    q.close()
     # Wait for all the downloads to complete.
-    t.join()
+    for t in threads:
+        t.join()
+    manifest.save()
+    log.close()
 
-    # List the lectures that we downloaded and those we skipped.
-    if len(all_downloaded) > 0:
-        print(f"Downloaded {len(all_downloaded)} lecture(s):")
-        for lecture in all_downloaded:
-            print(lecture.fName)
+    print_summary(log)
+    return result
 
-    if len(all_skipped) > 0:
-        print(f"Skipped {len(all_skipped)} lecture(s):")
-        for lecture in all_skipped:
-            print(lecture.fName + ": " + lecture.dl_status)
+
+def download(archive=False):
+    uni_folder = setup_uni_folder()
+
+    def queue_jobs(q, log):
+        crawl_times = profiled('crawl', crawl)(q, uni_folder, log,
+                                               archive=archive)
+        print("All links have been collected, waiting for downloads to complete...")
+        return crawl_times
+
+    crawl_times = run_downloads(uni_folder, queue_jobs)
+
+    if len(crawl_times) > 0:
+        print("Time spent crawling each subject:")
+        for subject, seconds in crawl_times:
+            print(f"{subject.code}: {seconds:.1f}s")
 
     print("\nDone!\n")
 
 
+def print_summary(log):
+    # List the lectures that we downloaded and those we skipped, reading them
+    # back from the log rather than keeping them all around.
+    if log.counts['downloaded'] > 0:
+        print(f"Downloaded {log.counts['downloaded']} lecture(s):")
+        for entry in log.read('downloaded'):
+            print(entry['name'])
+
+    if log.counts['skipped'] > 0:
+        print(f"Skipped {log.counts['skipped']} lecture(s):")
+        for entry in log.read('skipped'):
+            print(entry['name'] + ": " + entry['reason'])
+
+    if log.counts['failed'] > 0:
+        print(f"Failed to download {log.counts['failed']} lecture(s), run "
+              f"again to retry them:")
+        for entry in log.read('failed'):
+            print(entry['name'] + ": " + entry['reason'])
+    print(f"This is also in {log.path}")
+
+
+def plan(output, export=False):
+    ''' Crawls the LMS like download() does, but writes what would have been
+    downloaded (and what would have been skipped, and why) to output as JSON
+    instead of downloading it. If export is True the browser's cookies are
+    included too, so that work() can do the downloads on another machine.
+    '''
+    cookies = [] if export else None
+    q = DownloadPlan(settings['download_order'] or 'crawl')
+    uni_folder = setup_uni_folder()
+    log = RunLog(settings['run_log'])
+    profiled('crawl', crawl)(q, uni_folder, log, cookies)
+    manifest.save()
+    log.close()
+    q.add(log.read('skipped'), 'skipped')
+    q.add(log.read('failed'), 'failed')
+    data = q.to_dict(root=uni_folder)
+    if export:
+        # This is a live session, so keep it private.
+        data['cookies'] = cookies
+        write_private_json(output, data)
+    else:
+        with open(output, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    print(f"Planned {log.counts['queued']} download(s), skipping "
+          f"{log.counts['skipped']} lecture(s). Wrote the plan to {output}")
+    totals = data['totals']
+    if totals['bytes_to_transfer'] > totals['free_bytes']:
+        print(f"NOTE! This needs {totals['bytes_to_transfer'] / 1024**3:0.2f} "
+              f"GiB but there is only {totals['free_bytes'] / 1024**3:0.2f} "
+              f"GiB free in {uni_folder}.")
+
+
+def lecture_from_job(job, uni_folder):
+    ''' Rebuilds the Lecture for a job written by plan(), with its path under
+    uni_folder (which may be on a different machine).
+    '''
+    relative_path = job['relative_path'].split('/')
+    return Lecture(job['page'], job['subject'], job['week'], job['lecture'],
+                   datetime.datetime.strptime(job['date'], '%Y-%m-%d'),
+                   job['subject_name'], job['recording'], relative_path[0],
+                   fName=job['name'],
+                   fPath=os.path.join(uni_folder, *relative_path),
+                   period=job.get('period'))
+
+
+def work(jobs_file, shard, num_shards, uni_folder=None):
+    ''' Downloads this worker's share of the jobs in a file written by plan()
+    (usually via the export command). Every worker given the same file and
+    number of shards agrees on who downloads what, see assign_shard.
+    '''
+    load_network_stack()
+    with open(jobs_file) as f:
+        data = json.load(f)
+    # Pass on the session from the machine that did the crawling.
+    cookies = drop_expired_cookies(data.get('cookies', []))
+    if cookies:
+        # Only to the hosts they're for, not e.g. the media server or hooks.
+        urllib.request.install_opener(urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(cookie_jar(cookies))))
+
+    uni_folder = setup_uni_folder(uni_folder)
+    jobs = [job for job in data['lectures']
+            if job['status'] in ('new', 'incomplete')]
+    my_jobs = assign_shard(jobs, shard, num_shards)
+    print(f"Worker {shard}/{num_shards} has {len(my_jobs)} of {len(jobs)} "
+          f"download(s) from {jobs_file}")
+    # Say up front if this isn't all going to fit.
+    total = sum(job['bytes_to_transfer'] or 0 for job in my_jobs)
+    free = shutil.disk_usage(uni_folder).free
+    if storage.local and total > free:
+        print(f"NOTE! These downloads need {total / 1024**3:0.2f} GiB but "
+              f"there is only {free / 1024**3:0.2f} GiB free, some will "
+              f"have to wait or be skipped.")
+
+    def queue_jobs(q, log):
+        for job in my_jobs:
+            lec = lecture_from_job(job, uni_folder)
+            remember_lecture(lec, size=job['remote_bytes'])
+            # This machine may have refreshed the link since the export.
+            dl_link = link_cache.get(lec.link) or link_cache.put(lec.link,
+                                                                 job['link'])
+            file_index.makedirs(os.path.dirname(lec.fPath))
+            # Resume from whatever this machine has, not what the crawler had.
+            sizeLocal = 0
+            if file_index.isfile(lec.fPath):
+                sizeLocal = file_index.getsize(lec.fPath)
+            sizeWeb = job['remote_bytes']
+            if sizeWeb and sizeLocal >= sizeWeb:
+                lec.dl_status = "File already exists on disk (fully downloaded)."
+                log.record('skipped', lec)
+                continue
+            dl_func = functools.partial(download_lecture, dl_link, lec.fPath,
+                                        lec.fName, sizeLocal, page=lec.link)
+            q.put(dl_func, lec, sizeWeb - sizeLocal if sizeWeb else None)
+            log.record('queued', lec)
+
+    run_downloads(uni_folder, queue_jobs)
+    print("\nDone!\n")
+
+
+def lecture_from_entry(link, entry, uni_folder):
+    ''' Rebuilds a Lecture from what the manifest remembers about it, or
+    returns None if it doesn't remember enough.
+    '''
+    try:
+        folder = os.path.relpath(entry['path'], uni_folder).split(os.sep)[0]
+        return Lecture(link, entry['subject'], entry['week'], entry['lecture'],
+                       datetime.datetime.strptime(entry['date'], '%Y-%m-%d'),
+                       entry['subject_name'], entry['recording'], folder,
+                       fName=entry.get('name'), fPath=entry['path'],
+                       period=entry.get('period'), layout=entry.get('layout'))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def sync(prune=False, dry_run=False):
+    ''' Treats the lecture folders as a mirror of the recordings in the
+    manifest, without starting the browser. Files whose name has changed are
+    renamed (see follow_rename), missing or incomplete ones are downloaded
+    from the links found last time, and with prune, ones that have been
+    taken off the LMS are deleted (see mark_removed). With dry_run it only
+    says what it would do.
+    '''
+    uni_folder = setup_uni_folder()
+    default_mode = settings['media_type'] or 'video'
+    counts = Counter()
+    to_download = []
+    # Which recording each path goes to, so two can't end up in one file.
+    claimed = {}
+    for link, entry in sorted(manifest.entries().items(),
+                              key=lambda e: e[1].get('path') or ''):
+        lec = lecture_from_entry(link, entry, uni_folder)
+        if lec is None:
+            counts['unknown'] += 1
+            continue
+
+        if entry.get('removed'):
+            counts['removed'] += 1
+            if not prune:
+                print(f"{lec.fName} has been taken off the LMS")
+                continue
+            for suffix in ('', '.part', '.part.json'):
+                path = lec.fPath + suffix
+                if not file_index.isfile(path):
+                    continue
+                if dry_run:
+                    print(f"Would delete {path}")
+                else:
+                    storage.remove(path)
+                    print(f"Deleted {path}")
+            if not dry_run:
+                manifest.remove(link)
+            continue
+
+        name, path, layout = lecture_path(
+            lec, entry.get('media') or default_mode, uni_folder)
+        if not dry_run:
+            manifest.update(link, layout=layout)
+        if path == lec.fPath:
+            pass
+        elif (path in claimed or path_taken(path)
+              or manifest.find('path', path) is not None):
+            print(f"NOTE! Couldn't rename {lec.fPath} to {path}, something "
+                  f"else is already there. Check your name templates.")
+            counts['clash'] += 1
+        else:
+            there = path_taken(lec.fPath)
+            if dry_run:
+                if there:
+                    print(f"Would rename {lec.fPath} to {path}")
+            else:
+                move_lecture(lec.fPath, path)
+                lec.fName, lec.fPath = os.path.basename(name), path
+                manifest.update(link, name=lec.fName, path=lec.fPath)
+            # Nothing was there yet, so only the manifest needed changing.
+            if there:
+                counts['renamed'] += 1
+        claimed[lec.fPath] = link
+
+        sizeLocal = 0
+        if file_index.isfile(lec.fPath):
+            sizeLocal = file_index.getsize(lec.fPath)
+        size = entry.get('size')
+        if sizeLocal and (not size or sizeLocal >= size):
+            counts['ok'] += 1
+        elif not entry.get('url'):
+            # We never went to download it, e.g. it was outside the weeks.
+            counts['never'] += 1
+        else:
+            counts['missing'] += 1
+            if dry_run:
+                print(f"Would download {lec.fName}")
+            else:
+                to_download.append((lec, entry['url'], sizeLocal, size))
+
+    def queue_jobs(q, log):
+        for lec, url, sizeLocal, size in to_download:
+            file_index.makedirs(os.path.dirname(lec.fPath))
+            # The link may well have expired since, in which case
+            # download_lecture gets a new one.
+            dl_func = functools.partial(download_lecture, url, lec.fPath,
+                                        lec.fName, sizeLocal, page=lec.link)
+            q.put(dl_func, lec, size - sizeLocal if size else None)
+            log.record('queued', lec)
+        # For the summary below.
+        return log
+
+    # A dry run never gets as far as downloading anything.
+    if to_download:
+        load_network_stack()
+        # Expired links are fetched again from the lecture pages, which
+        # needs the session the crawler saved.
+        if settings['session_file']:
+            link_cache.cookies = load_cookies(settings['session_file'])
+        log = run_downloads(uni_folder, queue_jobs)
+        counts['downloaded'] = log.counts['downloaded']
+        counts['failed'] = log.counts['failed']
+    elif not dry_run:
+        # There's nothing to download, but there may be renames to remember.
+        manifest.save()
+
+    if dry_run:
+        downloads = f"{counts['missing']} to download"
+    else:
+        downloads = (f"{counts['downloaded']} downloaded, "
+                     f"{counts['failed']} failed")
+    print(f"{counts['ok']} lecture(s) up to date, {counts['renamed']} "
+          f"renamed, {downloads}, {counts['removed']} taken off the LMS"
+          + (" (dry run)" if dry_run else ""))
+    if counts['clash']:
+        print(f"{counts['clash']} lecture(s) couldn't be renamed, see above.")
+    if counts['removed'] and not prune:
+        print("Run sync --prune to delete the ones taken off the LMS.")
+    if counts['never']:
+        print(f"{counts['never']} recording(s) have never been downloaded, "
+              f"run archive to get them.")
+
+
 if __name__ == '__main__':
     main()
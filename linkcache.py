@@ -0,0 +1,96 @@
+import calendar
+import html
+import re
+import time
+
+from contextlib import suppress
+from util import cookie_jar
+
+# What a media server says when a signed link has expired.
+LINK_EXPIRED_CODES = (403, 410)
+# Seconds before a link's expiry that we stop trusting it, so that it
+# doesn't run out just as a download starts.
+EXPIRY_MARGIN = 60
+# Seconds to wait for a lecture page when refreshing its link.
+PAGE_TIMEOUT = 60
+# The link the download page redirects to, see get_download_link.
+MEDIA_LINK = re.compile(r'<a\b[^>]*?\bhref\s*=\s*["\']([^"\']+)["\'][^>]*>'
+                        r'\s*Download media file\.', re.IGNORECASE)
+
+
+class LinkExpiredError(ConnectionError):
+    ''' Raised once an expired link has been refreshed, so that trying again
+    picks up the new one.
+    '''
+
+
+def link_expired(e):
+    return getattr(e, 'code', None) in LINK_EXPIRED_CODES
+
+
+def link_expiry(url, ttl):
+    ''' Returns when a signed media link stops working, going by what it
+    says itself where it can, otherwise ttl seconds from now.
+    '''
+    import urllib.parse
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    # CloudFront and S3 (version 2) signed links.
+    with suppress(KeyError, ValueError):
+        return float(query['Expires'])
+    # S3 (version 4) signed links.
+    with suppress(KeyError, ValueError):
+        signed = calendar.timegm(time.strptime(query['X-Amz-Date'],
+                                               '%Y%m%dT%H%M%SZ'))
+        return signed + int(query['X-Amz-Expires'])
+    return time.time() + ttl
+
+
+class LinkCache(object):
+    ''' Remembers the media link each lecture page resolves to, and until
+    when it can be used, in the manifest. So the size check and the download
+    share one trip to the page, and later runs (and sync) can skip it while
+    the link is still good. A link that turns out to have expired early can
+    be refreshed without the browser, as long as we have the cookies for
+    the lecture pages (or they're in the installed urllib opener).
+    '''
+
+    def __init__(self, manifest, ttl=3600):
+        self.manifest = manifest
+        self.ttl = ttl
+        # The browser's cookies for the lecture pages, see refresh().
+        self.cookies = None
+
+    def get(self, page):
+        ''' Returns the media link for page, or None if we don't have one
+        that's still good.
+        '''
+        entry = self.manifest.get(page)
+        if not entry or not entry.get('url'):
+            return None
+        if (entry.get('url_expires') or 0) < time.time() + EXPIRY_MARGIN:
+            return None
+        return entry['url']
+
+    def put(self, page, url):
+        self.manifest.update(page, url=url,
+                             url_expires=link_expiry(url, self.ttl))
+        return url
+
+    def refresh(self, page):
+        ''' Fetches page again for a new media link, raising ValueError if
+        there isn't one on it.
+        '''
+        import urllib.parse
+        import urllib.request
+        open_url = urllib.request.urlopen
+        if self.cookies:
+            open_url = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(cookie_jar(self.cookies))
+            ).open
+        with open_url(page, timeout=PAGE_TIMEOUT) as f:
+            text = f.read().decode('utf-8', 'replace')
+        match = MEDIA_LINK.search(text)
+        if match is None:
+            raise ValueError(f'No media link on {page}')
+        url = urllib.parse.urljoin(page, html.unescape(match.group(1)))
+        return self.put(page, url)
@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+import time
+
+
+class Manifest(object):
+    ''' Remembers what we've learnt about each recording between runs, such
+    as which subject and week it belongs to, where we saved it and how big it
+    is on the server, so we don't have to go back to the LMS to find out.
+    Entries are dicts keyed by the recording's link, and the whole thing is
+    saved as JSON next to the lectures.
+    '''
+
+    def __init__(self):
+        self.path = None
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def load(self, path):
+        with self._lock:
+            self.path = path
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)
+            except FileNotFoundError:
+                self._entries = {}
+            except ValueError:
+                print(f'Couldn\'t read {path}, starting a new manifest.')
+                self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry) if entry is not None else None
+
+    def update(self, key, **fields):
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            entry.update(fields)
+            entry['updated'] = time.time()
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def find(self, field, value):
+        ''' Returns the key of an entry whose field is value, or None. '''
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.get(field) == value:
+                    return key
+            return None
+
+    def entries(self):
+        with self._lock:
+            return {key: dict(entry) for key, entry in self._entries.items()}
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            # Write then rename, so a crash can't leave a half written file.
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,85 @@
+import os
+import re
+import string
+
+# e.g. COMP30022 Week 09 Lecture 1
+DEFAULT_NAME_TEMPLATE = '{code} Week {week:02} Lecture {lecture}'
+# Lectures from earlier teaching periods, e.g. 2016 SM2/COMP30022 Week 09 Lecture 1
+DEFAULT_ARCHIVE_TEMPLATE = '{period}/' + DEFAULT_NAME_TEMPLATE
+DEFAULT_EXTENSIONS = {'audio': '.mp3', 'video': '.m4v'}
+
+# What can go in a template, see lecture_fields.
+FIELDS = ('code', 'subject', 'week', 'lecture', 'recording', 'date', 'year',
+          'period', 'semester')
+# Characters that can't go in a file name on at least one OS.
+UNSAFE_CHARACTERS = re.compile(r'[<>:"/\\|?*]')
+
+
+def lecture_fields(lec):
+    period = lec.period or ''
+    return {
+        'code': lec.subjCode,
+        'subject': lec.subjName,
+        'week': lec.week,
+        'lecture': lec.lecOfWeek,
+        'recording': lec.recNum,
+        'date': lec.date,
+        'year': lec.date.year,
+        'period': period,
+        # Just the semester part of the period, e.g. SM2.
+        'semester': period.split(' ')[-1],
+    }
+
+
+class NameTemplate(object):
+    ''' A naming convention for lecture files, written as a format string
+    such as '{code} Week {week:02} Lecture {lecture}' (see lecture_fields for
+    what's available). Slashes in the template make subfolders.
+    The template is parsed and checked once up front, so a typo shows up
+    when we start rather than on the first lecture.
+    '''
+
+    def __init__(self, template):
+        self.template = template
+        self._parts = []
+        try:
+            parsed = list(string.Formatter().parse(template))
+        except ValueError as e:
+            raise ValueError(f'"{template}" isn\'t a valid template: {e}')
+        for literal, field, spec, conversion in parsed:
+            if field is not None and field not in FIELDS:
+                raise ValueError(f'Unknown field {{{field}}} in "{template}", '
+                                 f'choose from: {", ".join(FIELDS)}')
+            self._parts.append((literal, field, spec or '', conversion))
+
+    def render(self, lec):
+        ''' Returns the lecture's file name (without the extension), which
+        may include subfolders.
+        '''
+        values = lecture_fields(lec)
+        out = []
+        for literal, field, spec, conversion in self._parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion is not None:
+                value = str(value)
+            # A subject name with a slash in it shouldn't make a folder.
+            out.append(UNSAFE_CHARACTERS.sub('-', format(value, spec)))
+        return os.path.join(*''.join(out).split('/'))
+
+
+class NameFunction(object):
+    ''' Stands in for a NameTemplate for settings files that name lectures
+    with a getLectureName function instead.
+    '''
+
+    def __init__(self, function):
+        self.template = function.__name__
+        self.function = function
+
+    def render(self, lec):
+        return self.function(lec)
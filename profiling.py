@@ -0,0 +1,168 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+
+# Seconds between stack samples, see ThreadProfiler.
+SAMPLE_INTERVAL = 0.01
+# How many functions go in each thread's text report.
+REPORT_LINES = 40
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+def describe_counts(counts):
+    parts = []
+    if counts['subjects']:
+        parts.append(f"{counts['subjects']} subject(s)")
+    if counts['lectures']:
+        parts.append(f"{counts['lectures']} lecture(s)")
+    if counts['failed']:
+        parts.append(f"{counts['failed']} failed")
+    if counts['bytes']:
+        parts.append(f"{counts['bytes'] / 1024**2:0.1f} MiB")
+    return ', '.join(parts) or 'nothing'
+
+
+class ThreadProfile(object):
+    __slots__ = ['name', 'profile', 'counts', 'cpu', 'wall', 'samples']
+
+    def __init__(self, name):
+        self.name = name
+        # Timed with the thread's CPU time, so time spent waiting on the
+        # network or the browser doesn't drown out what actually costs CPU.
+        self.profile = cProfile.Profile(time.thread_time)
+        self.counts = Counter()
+        self.cpu = 0
+        self.wall = 0
+        # Stack (outermost first) -> how many times it was sampled.
+        self.samples = Counter()
+
+
+class ThreadProfiler(object):
+    ''' Profiles the crawl and each download thread separately, see
+    --profile. Each thread run through wrap() gets a cProfile of its own, and
+    a background thread samples the stacks of all of them every
+    SAMPLE_INTERVAL seconds to make a collapsed stack file for flame graphs
+    (e.g. flamegraph.pl stacks.collapsed > flame.svg). The samples are of
+    wall time, so waiting shows up there too. Threads can add to their own
+    counts (lectures, bytes and so on) with count(), and these go alongside
+    their profiles.
+    '''
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._threads = {}
+        self._by_ident = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True,
+                                         name='profiler')
+        self._started = None
+
+    def start(self):
+        self._started = time.monotonic()
+        self._sampler.start()
+
+    def wrap(self, name, function):
+        ''' Returns function, profiled as the thread name whenever it runs. '''
+        return functools.partial(self._run, name, function)
+
+    def _run(self, name, function, *args, **kwargs):
+        with self._lock:
+            thread = self._threads.get(name)
+            if thread is None:
+                thread = self._threads[name] = ThreadProfile(name)
+            self._by_ident[threading.get_ident()] = thread
+        cpu_start = time.thread_time()
+        wall_start = time.monotonic()
+        try:
+            thread.profile.enable()
+        except ValueError as e:
+            # Python 3.12 and later only allow one cProfile at a time.
+            # The stack samples still cover this thread.
+            print(f'Not profiling {name} with cProfile: {e}', file=sys.stderr)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            thread.profile.disable()
+            thread.cpu += time.thread_time() - cpu_start
+            thread.wall += time.monotonic() - wall_start
+            with self._lock:
+                self._by_ident.pop(threading.get_ident(), None)
+
+    def count(self, **counts):
+        ''' Adds to the counts of the thread we're on, if it's profiled. '''
+        thread = self._by_ident.get(threading.get_ident())
+        if thread is not None:
+            thread.counts.update(counts)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                watched = list(self._by_ident.items())
+            for ident, thread in watched:
+                frame = frames.get(ident)
+                stack = []
+                # Stop at _run(), what's above it is the same every time.
+                while (frame is not None and
+                       frame.f_code is not ThreadProfiler._run.__code__):
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    thread.samples[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def write(self, directory):
+        ''' Writes a profile (.prof, for pstats or snakeviz) and a text report
+        for each thread to directory, along with stacks.collapsed and a JSON
+        summary of what each thread got through.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        wall = time.monotonic() - self._started
+        totals = Counter()
+        summary = {'wall_seconds': round(wall, 3),
+                   'sample_interval': self.interval,
+                   'threads': {}}
+        with open(os.path.join(directory, 'stacks.collapsed'), 'w') as stacks:
+            for name, thread in sorted(self._threads.items()):
+                totals.update(thread.counts)
+                label = f'{name} ({describe_counts(thread.counts)})'
+                summary['threads'][name] = dict(
+                    thread.counts, cpu_seconds=round(thread.cpu, 3),
+                    wall_seconds=round(thread.wall, 3),
+                    samples=sum(thread.samples.values()))
+                for stack, samples in thread.samples.items():
+                    stacks.write(';'.join((label,) + stack) + f' {samples}\n')
+                self._write_thread(directory, thread, label)
+        summary['totals'] = dict(totals)
+        with open(os.path.join(directory, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    def _write_thread(self, directory, thread, label):
+        path = os.path.join(directory, thread.name)
+        try:
+            stats = pstats.Stats(thread.profile)
+        except TypeError:
+            # It never got to run under cProfile, see wrap().
+            return
+        stats.dump_stats(path + '.prof')
+        with open(path + '.txt', 'w') as f:
+            f.write(f'# {label}\n')
+            f.write(f'# {thread.cpu:0.2f}s CPU over {thread.wall:0.2f}s\n')
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+
@@ -0,0 +1,54 @@
+import json
+import sys
+import threading
+
+from collections import Counter
+from hooks import HOOK_EVENTS
+from scheduler import describe_lecture
+
+
+class RunLog(object):
+    ''' Writes down what happened to each lecture during a run (queued,
+    downloaded, skipped or failed, and why) as it happens, one JSON object
+    per line, so that only the counts have to be kept in memory however many
+    recordings there are. The summary at the end is read back from the file.
+    If given a HookDispatcher, its hooks are told about each lecture as it is
+    downloaded, fails or is skipped.
+    '''
+
+    def __init__(self, path, hooks=None):
+        self.path = path
+        self.hooks = hooks
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+
+    def record(self, outcome, lec):
+        entry = dict(describe_lecture(lec), outcome=outcome,
+                     reason=lec.dl_status)
+        with self._lock:
+            # Not being able to write it down (e.g. the disk is full) mustn't
+            # stop the download threads, it just won't be in the summary.
+            try:
+                self._file.write(json.dumps(entry) + '\n')
+                # Flush as we go so the log is useful even if we crash.
+                self._file.flush()
+            except OSError as e:
+                print(f'Couldn\'t write to {self.path}: {e}', file=sys.stderr)
+            self.counts[outcome] += 1
+        if self.hooks is not None and outcome in HOOK_EVENTS:
+            self.hooks.fire(outcome, entry)
+
+    def read(self, outcome):
+        ''' Yields the entries with the given outcome, oldest first. '''
+        with open(self.path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['outcome'] == outcome:
+                    yield entry
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        if self.hooks is not None:
+            self.hooks.close()
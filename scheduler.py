@@ -0,0 +1,327 @@
+import datetime
+import heapq
+import itertools
+import os
+import shutil
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import suppress
+
+
+class DownloadJob(object):
+    def __init__(self, dl_func, lecture, size, seq, turn):
+        self.dl_func = dl_func
+        self.lecture = lecture
+        # Expected number of bytes left to transfer, None if unknown.
+        self.size = size
+        # Order in which the job was queued, used to break ties.
+        self.seq = seq
+        # How many jobs for the same subject were queued before this one.
+        self.turn = turn
+        # If set, the job was turned away and shouldn't be run, see
+        # DiskSpaceAdmission.
+        self.rejected = None
+
+    def __str__(self):
+        return self.lecture.fName
+
+
+# Each policy maps a job to a sort key, smallest keys are downloaded first.
+# Ties always fall back to the order in which the jobs were queued.
+def _crawl_order(job):
+    return ()
+
+
+def _newest_first(job):
+    return (-job.lecture.date.timestamp(),)
+
+
+def _smallest_first(job):
+    # Jobs we don't know the size of go to the back of the line.
+    return (job.size if job.size is not None else float('inf'),)
+
+
+def _subject_fair(job):
+    # Round robin, the nth lecture of every subject goes before the (n+1)th.
+    return (job.turn, -job.lecture.date.timestamp())
+
+
+POLICIES = {
+    'crawl': _crawl_order,
+    'newest': _newest_first,
+    'smallest': _smallest_first,
+    'fair': _subject_fair,
+}
+
+
+class DiskSpaceAdmission(object):
+    ''' Decides whether there is room on disk to start a download, keeping
+    reserve bytes free. Space promised to downloads that have started but not
+    finished is counted as used, less whatever they've already taken up on
+    disk (e.g. by preallocating), since that's already gone from what's free.
+    '''
+
+    def __init__(self, folder, reserve=0):
+        self.folder = folder
+        self.reserve = reserve
+        # How much space each admitted job had taken up when it was admitted.
+        self._started = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def allocated(job):
+        ''' How much space the job's files are taking up on disk. '''
+        total = 0
+        for path in (job.lecture.fPath, job.lecture.fPath + '.part'):
+            with suppress(OSError):
+                st = os.stat(path)
+                # st_blocks counts preallocated space, st_size might not.
+                total += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+        return total
+
+    def promised(self):
+        return sum(max(0, job.size - (self.allocated(job) - started))
+                   for job, started in self._started.items())
+
+    def free(self):
+        free = shutil.disk_usage(self.folder).free
+        return free - self.reserve - self.promised()
+
+    def admit(self, job):
+        with self._lock:
+            # We can't know whether a job of unknown size fits, so let it try.
+            if job.size is None:
+                return self.free() > 0
+            if job.size > self.free():
+                return False
+            self._started[job] = self.allocated(job)
+            return True
+
+    def release(self, job):
+        with self._lock:
+            self._started.pop(job, None)
+
+
+class DownloadScheduler(object):
+    ''' A thread-safe replacement for queue.Queue that hands out download jobs
+    according to a policy rather than in the order they were queued.
+    Use close() once everything has been queued, after which get() returns
+    None as soon as the queue runs dry.
+
+    If given an admission (see DiskSpaceAdmission), get() hands out the first
+    job the admission lets through, so smaller jobs can go ahead of a big one
+    that doesn't fit. If none fit, get() waits up to max_wait seconds for
+    space to free up, after which it hands out the jobs that still don't fit
+    with their rejected reason set, for the caller to report. That wait is
+    shared by every get(), and starts again once a job is let through.
+
+    If maxsize is given, put() blocks while that many jobs are waiting, so
+    whoever is queueing can't get too far ahead of whoever is downloading.
+    The policy then only orders the jobs that are waiting at the time.
+    '''
+
+    # How often to check whether space has freed up while waiting.
+    ADMISSION_POLL = 10
+
+    def __init__(self, policy='crawl', admission=None, max_wait=300,
+                 maxsize=0):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown download order "{policy}", choose '
+                             f'from: {", ".join(POLICIES)}')
+        self.policy = policy
+        self.key = POLICIES[policy]
+        self.admission = admission
+        self.max_wait = max_wait
+        self.maxsize = maxsize
+        # Whether we need to know how big each download is.
+        self.needs_sizes = policy == 'smallest' or admission is not None
+        self._heap = []
+        self._seq = itertools.count()
+        self._subject_turns = defaultdict(int)
+        self._closed = False
+        self._cond = threading.Condition()
+        # When we started waiting for space, None if we aren't.
+        self._waiting_since = None
+
+    def put(self, dl_func, lecture, size=None):
+        with self._cond:
+            while self.maxsize and len(self._heap) >= self.maxsize:
+                self._cond.wait()
+            seq = next(self._seq)
+            turn = self._subject_turns[lecture.subjCode]
+            self._subject_turns[lecture.subjCode] += 1
+            job = DownloadJob(dl_func, lecture, size, seq, turn)
+            heapq.heappush(self._heap, (self.key(job), seq, job))
+            self._cond.notify_all()
+        return job
+
+    def get(self):
+        with self._cond:
+            job = self._next_job()
+            # There's room for put() again.
+            self._cond.notify_all()
+            return job
+
+    def _next_job(self):
+        while True:
+            while not self._heap and not self._closed:
+                self._cond.wait()
+            if not self._heap:
+                return None
+            if self.admission is None:
+                return heapq.heappop(self._heap)[-1]
+            job = self._pop_admitted()
+            if job is not None:
+                self._waiting_since = None
+                return job
+            # Nothing fits, wait for space to free up.
+            if self._waiting_since is None:
+                self._waiting_since = time.monotonic()
+                print(f'Not enough disk space for the next download, '
+                      f'waiting up to {self.max_wait}s for some to free up.')
+            elif time.monotonic() - self._waiting_since >= self.max_wait:
+                job = heapq.heappop(self._heap)[-1]
+                job.rejected = 'Not enough disk space'
+                return job
+            self._cond.wait(self.ADMISSION_POLL)
+
+    def _pop_admitted(self):
+        for entry in sorted(self._heap):
+            if self.admission.admit(entry[-1]):
+                self._heap.remove(entry)
+                heapq.heapify(self._heap)
+                return entry[-1]
+        return None
+
+    def done(self, job):
+        ''' Call once a job from get() has finished, successfully or not. '''
+        if self.admission is not None and job.rejected is None:
+            self.admission.release(job)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+
+class DownloadPlan(object):
+    ''' Stands in for a DownloadScheduler when planning: instead of
+    downloading the jobs it's given, it writes out what would have been
+    downloaded (in the order it would have been downloaded in), along with
+    the lectures that would have been skipped and how much there is to
+    transfer.
+    '''
+
+    # A plan always reports how much there is to download.
+    needs_sizes = True
+
+    def __init__(self, policy='crawl'):
+        self.policy = policy
+        # Nothing is taken off the queue until the end, so it can't be bounded.
+        self._scheduler = DownloadScheduler(policy)
+        self._others = []
+
+    def put(self, dl_func, lecture, size=None):
+        return self._scheduler.put(dl_func, lecture, size)
+
+    def add(self, entries, status):
+        ''' Adds lectures that won't be downloaded (e.g. skipped or failed),
+        as entries read back from a RunLog.
+        '''
+        for entry in entries:
+            entry = dict(entry, status=status)
+            del entry['outcome']
+            self._others.append(entry)
+
+    def jobs(self):
+        ''' Describes the queued jobs, in the order they'd be downloaded.
+        This empties the plan's queue, so only call it once.
+        '''
+        self._scheduler.close()
+        jobs = []
+        while True:
+            job = self._scheduler.get()
+            if job is None:
+                return jobs
+            dl_link, output_name, pretty_name, sizeLocal = job.dl_func.args
+            jobs.append(dict(
+                describe_lecture(job.lecture),
+                status='incomplete' if sizeLocal else 'new',
+                reason=job.lecture.dl_status,
+                link=dl_link,
+                local_bytes=sizeLocal,
+                remote_bytes=(job.size + sizeLocal
+                              if job.size is not None else None),
+                bytes_to_transfer=job.size,
+            ))
+
+    def to_dict(self, root=None):
+        ''' If root is given, each lecture's path is also given relative to
+        it, so the plan can be carried out somewhere else.
+        '''
+        lectures = self.jobs() + self._others
+        if root is not None:
+            for lec in lectures:
+                # Always with forward slashes, the other end might not be
+                # running the same OS.
+                relative_path = os.path.relpath(lec['path'], root)
+                lec['relative_path'] = relative_path.replace(os.sep, '/')
+        totals = {'bytes_to_transfer': 0, 'unknown_size': 0}
+        if root is not None:
+            totals['free_bytes'] = shutil.disk_usage(root).free
+        for lec in lectures:
+            totals[lec['status']] = totals.get(lec['status'], 0) + 1
+            if lec['status'] in ('new', 'incomplete'):
+                if lec['bytes_to_transfer'] is None:
+                    totals['unknown_size'] += 1
+                else:
+                    totals['bytes_to_transfer'] += lec['bytes_to_transfer']
+        return {
+            'generated': datetime.datetime.now().isoformat(),
+            'download_order': self.policy,
+            'totals': totals,
+            'lectures': lectures,
+        }
+
+
+def describe_lecture(lec):
+    return {
+        'name': lec.fName,
+        'path': lec.fPath,
+        'subject': lec.subjCode,
+        'subject_name': lec.subjName,
+        'date': lec.date.strftime('%Y-%m-%d'),
+        'week': lec.week,
+        'lecture': lec.lecOfWeek,
+        'recording': lec.recNum,
+        'period': lec.period,
+        'page': lec.link,
+    }
+
+
+def assign_shard(jobs, shard, num_shards):
+    ''' Splits jobs between num_shards workers and returns the ones for shard
+    (counting from 1). Each job goes to whichever shard has the fewest bytes
+    so far, biggest jobs first, so every worker gets a similar amount to
+    download. The split only depends on the jobs, so every worker works out
+    the same split without having to talk to the others.
+    '''
+    # (bytes, number of jobs, shard), so jobs of unknown size still spread out.
+    loads = [(0, 0, i) for i in range(num_shards)]
+    mine = []
+    by_size = sorted(enumerate(jobs),
+                     key=lambda j: (-(j[1].get('bytes_to_transfer') or 0), j[0]))
+    for index, job in by_size:
+        load, count, i = heapq.heappop(loads)
+        load += job.get('bytes_to_transfer') or 0
+        heapq.heappush(loads, (load, count + 1, i))
+        if i == shard - 1:
+            mine.append((index, job))
+    # Keep the original order (i.e. the download order) within the shard.
+    return [job for index, job in sorted(mine, key=lambda j: j[0])]
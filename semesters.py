@@ -0,0 +1,75 @@
+import datetime
+
+# Used when the settings don't say otherwise. Each teaching period starts on
+# the Monday on or before start (month, day) and has weeks teaching weeks,
+# with a week off for the mid-semester break after week break_after.
+DEFAULT_TEACHING_PERIODS = [
+    {'name': 'SM1', 'start': (2, 27), 'weeks': 12, 'break_after': 6},
+    {'name': 'SM2', 'start': (7, 24), 'weeks': 12, 'break_after': 9},
+]
+
+
+class TeachingPeriod(object):
+    ''' A semester (or other teaching period) in a particular year, which
+    knows which teaching week each of its days falls in.
+    '''
+
+    def __init__(self, year, name, start, weeks=12, break_after=None):
+        self.year = year
+        self.name = name
+        # Monday of week 1, at midnight.
+        self.start = start
+        self.weeks = weeks
+        self.break_after = break_after
+
+    def __str__(self):
+        return f'{self.year} {self.name}'
+
+    def week_of(self, date):
+        ''' Returns the teaching week date falls in, or None if it's outside
+        the teaching weeks (which includes the mid-semester break).
+        '''
+        days = (date - self.start).days
+        if days < 0:
+            return None
+        week = days // 7 + 1
+        if self.break_after and week > self.break_after:
+            if week == self.break_after + 1:
+                return None
+            week -= 1
+        return week if week <= self.weeks else None
+
+
+def monday_on_or_before(date):
+    return date - datetime.timedelta(days=date.weekday())
+
+
+def periods_for_year(year, config=None):
+    periods = []
+    for p in config or DEFAULT_TEACHING_PERIODS:
+        start = monday_on_or_before(datetime.datetime(year, *p['start']))
+        periods.append(TeachingPeriod(year, p['name'], start,
+                                      p.get('weeks', 12),
+                                      p.get('break_after')))
+    return periods
+
+
+def find_period(date, config=None):
+    ''' Returns (period, week) for the teaching week date falls in, or
+    (None, None) if it isn't in one.
+    '''
+    for period in periods_for_year(date.year, config):
+        week = period.week_of(date)
+        if week is not None:
+            return period, week
+    return None, None
+
+
+def current_period(today, config=None):
+    ''' The latest teaching period to have started by today, so between
+    semesters it's the one that just finished.
+    '''
+    candidates = (periods_for_year(today.year - 1, config)
+                  + periods_for_year(today.year, config))
+    return max((p for p in candidates if p.start <= today),
+               key=lambda p: p.start)
@@ -1,13 +1,15 @@
 # Don't import this directly.
 
+from naming import DEFAULT_NAME_TEMPLATE, NameTemplate
+
+
 def getLectureName(lecture):
-    ''' Sets the naming convention for lecture files.
-    Current preference: COMP30022 Week 09 Lecture 1
-    f'{lecture.subjCode} Week {lecture.week:02} Lecture {lecture.lecOfWeek}'
-    Another preference: Models of Computation - L09
-    f'{lec.subjName} - L{lec.recNum:02}'
+    ''' Older settings files imported this from here. Lectures are now named
+    with lecture_name_template (below), so define your own getLectureName
+    only if a template can't do what you want.
     '''
-    return f'{lecture.subjCode} Week {lecture.week:02} Lecture {lecture.lecOfWeek}'
+    return NameTemplate(DEFAULT_NAME_TEMPLATE).render(lecture)
+
 
 _settings_base = {
     # Whether to download video or audio.
@@ -23,4 +25,100 @@ _settings_base = {
     'hide_window': False,  # This is headless Chrome mode.
     # This is relative to where lectureDL.py is in the file system.
     'driver_relative_path': 'chromedriver',
+    # The order in which queued lectures are downloaded. One of:
+    # 'crawl' - In the order they were found (subject by subject).
+    # 'newest' - Most recent recordings first.
+    # 'smallest' - Smallest remaining download first.
+    # 'fair' - Round robin across subjects, newest first within each.
+    'download_order': 'newest',
+    # How many times to retry a failed download or page load before giving up
+    # on that lecture. Retries back off exponentially.
+    'max_retries': 5,
+    # After this many downloads in a row fail (retries don't count), give the
+    # media server circuit_breaker_cooldown seconds to recover before trying
+    # it again. Downloads wait for it once, then fail straight away.
+    'circuit_breaker_threshold': 5,
+    'circuit_breaker_cooldown': 60,
+    # Don't load images, fonts, media or trackers while crawling the LMS.
+    # We only need the text and links on each page, so this is much faster.
+    'lean_crawl': True,
+    # Chrome keeps its cache and cookies here between runs, so if you're still
+    # signed in from last time the login is skipped. Relative to where
+    # lectureDL.py is run from. Set to '' to start from scratch every time.
+    'browser_profile_dir': 'chrome_profile',
+    # Session cookies are saved here after logging in (readable only by you),
+    # so the next run can skip the login if the session is still valid.
+    # Set to '' to log in every time.
+    'session_file': '.lectureDL_session.json',
+    # What we know about each recording (e.g. its size on the server) is kept
+    # in this file inside your uni folder, so later runs can skip asking.
+    'manifest_name': '.lectureDL_manifest.json',
+    # Reserve the full size of each download on disk before starting it, so
+    # the files don't end up fragmented. Downloads in progress end in .part.
+    'preallocate': True,
+    # Don't start a download if it would leave less than this much space free.
+    'free_space_reserve_mb': 500,
+    # How long to wait for space to free up before giving up on the downloads
+    # that don't fit (they'll be retried next run).
+    'disk_space_wait': 300,
+    # How many downloads can be queued up before the crawler waits for some
+    # to finish, so huge backfills don't pile up in memory. 0 for no limit.
+    'max_queued_downloads': 100,
+    # What happened to each lecture in the last run is written here as it
+    # happens, one JSON object per line. The summary at the end is read back
+    # from it.
+    'run_log': 'lectureDL_run.jsonl',
+    # When each semester runs, used to work out which week a recording is
+    # from. Each starts on the Monday on or before start (month, day), has
+    # weeks teaching weeks, and a week off after week break_after.
+    # Recordings from earlier semesters go in a folder named after the
+    # semester (e.g. 'Lectures/2016 SM2').
+    'teaching_periods': [
+        {'name': 'SM1', 'start': (2, 27), 'weeks': 12, 'break_after': 6},
+        {'name': 'SM2', 'start': (7, 24), 'weeks': 12, 'break_after': 9},
+    ],
+    # How many lectures to download at once.
+    'download_threads': 1,
+    # The naming convention for lecture files, inside each subject's lecture
+    # folder. You can use {code}, {subject}, {week}, {lecture} (of the week),
+    # {recording} (of the semester), {date}, {year}, {period} (e.g. 2017 SM2)
+    # and {semester} (e.g. SM2), with format specs like {week:02} or
+    # {date:%Y-%m-%d}. Slashes make subfolders.
+    # Current preference: COMP30022 Week 09 Lecture 1
+    # Another preference: '{subject} - L{recording:02}'
+    #   (Models of Computation - L09)
+    # If you change these, files you've already downloaded are renamed to
+    # match the next time they come up, rather than downloaded again.
+    'lecture_name_template': '{code} Week {week:02} Lecture {lecture}',
+    # The same for lectures from earlier semesters.
+    'archive_name_template': '{period}/{code} Week {week:02} Lecture {lecture}',
+    # The file extension for each media_type.
+    'media_extensions': {'audio': '.mp3', 'video': '.m4v'},
+    # Things to tell as soon as each lecture is downloaded, fails or is
+    # skipped, e.g. to start transcribing it. Each can be a shell command
+    # (given LECTUREDL_EVENT, LECTUREDL_PATH etc. in its environment and the
+    # details as JSON on stdin), a URL to POST the details to as JSON, or a
+    # Python function taking (event, details). They run in the background,
+    # so they don't slow the downloads down. Commands are stopped after five
+    # minutes, so start anything slower in the background yourself. e.g.
+    # ['python transcribe.py', 'http://localhost:8000/lectures']
+    'hooks': [],
+    # Read the whole list of recordings with one script per subject, rather
+    # than clicking on each recording and waiting for the page every time.
+    # Turn this off if recordings are being missed.
+    'bulk_scrape': True,
+    # Where to keep the lectures. None keeps them in uni_location. To send
+    # them straight to an S3-compatible store (AWS, MinIO etc.) instead, so
+    # they never have to fit on this machine's disk, use e.g.
+    # {'type': 's3', 'endpoint': 'http://localhost:9000', 'bucket': 'uni',
+    #  'prefix': 'lectures/', 'access_key': '...', 'secret_key': '...'}
+    # Each lecture's key is its path under uni_location, after the prefix.
+    # The keys default to AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY, and you
+    # can also set 'region' (default us-east-1) and 'part_size_mb' (how much
+    # of each download to upload at a time, default 16).
+    'storage': None,
+    # How many seconds to keep using a lecture's media link for, if the link
+    # doesn't say when it expires. Links are reused by later runs and sync
+    # until then, and are fetched again if they stop working early.
+    'media_link_ttl': 3600,
 }
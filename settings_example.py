@@ -2,7 +2,7 @@
 import os
 
 from collections import defaultdict
-from settings_base import _settings_base, getLectureName
+from settings_base import _settings_base
 
 settings = {
     # Your LMS username and password.
@@ -0,0 +1,326 @@
+import calendar
+import hashlib
+import hmac
+import os
+import shutil
+import time
+
+from contextlib import suppress
+from util import PartFile
+
+# Seconds to wait on the storage server before treating it as gone.
+STORAGE_TIMEOUT = 60
+# S3 won't take parts smaller than this, other than the last one.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class StorageError(OSError):
+    pass
+
+
+class LocalStorage(object):
+    ''' Keeps lectures on the local disk, under uni_location. Everything we
+    know about what's there is kept in a FileIndex.
+    '''
+    local = True
+
+    def __init__(self, index, preallocate=True):
+        self.index = index
+        self.preallocate = preallocate
+        self.root = None
+
+    def __str__(self):
+        return self.root
+
+    def scan(self, root):
+        self.root = os.path.abspath(root)
+        self.index.scan(root)
+
+    def part(self, path, start):
+        ''' Returns what a download to path should be written to (see
+        util.PartFile), or None to write to path itself, appending from
+        byte start.
+        '''
+        if start or not self.preallocate or not PartFile.supported():
+            return None
+        return PartFile(path)
+
+    def refresh(self, path):
+        self.index.refresh(path)
+
+    def move(self, old_path, new_path):
+        self.index.makedirs(os.path.dirname(new_path))
+        shutil.move(old_path, new_path)
+        self.index.refresh(old_path)
+        self.index.refresh(new_path)
+
+    def remove(self, path):
+        os.remove(path)
+        self.index.refresh(path)
+
+
+class S3Storage(object):
+    ''' Keeps lectures in a bucket on an S3-compatible server (AWS, MinIO and
+    the like) rather than on the local disk. Each lecture's key is its path
+    under uni_location, after prefix. Downloads are streamed straight into
+    multipart uploads (see S3Upload), so only a part's worth of each one is
+    ever held, in memory. The objects in the bucket are listed into the
+    FileIndex up front, so checking whether a lecture has been downloaded
+    costs the same as it does locally.
+    If given a RetryPolicy, each request to the server is retried with it,
+    other than those giveup(e) says not to.
+    '''
+    local = False
+
+    def __init__(self, index, endpoint, bucket, prefix='', region='us-east-1',
+                 access_key=None, secret_key=None, part_size_mb=16,
+                 retry=None, giveup=None):
+        # urllib is slow to import, so only do so if we're using S3.
+        global http, urllib
+        import http.client
+        import urllib.error
+        import urllib.parse
+        import urllib.request
+        self.index = index
+        self.endpoint = endpoint.rstrip('/')
+        self.host = urllib.parse.urlparse(self.endpoint).netloc
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.part_size = max(MIN_PART_SIZE, int(part_size_mb * 1024 * 1024))
+        self.retry = retry
+        self.giveup = giveup
+        self.root = None
+
+    def __str__(self):
+        return f'{self.endpoint}/{self.bucket}/{self.prefix}'
+
+    def key(self, path):
+        relative = os.path.relpath(os.path.abspath(path), self.root)
+        return self.prefix + relative.replace(os.sep, '/')
+
+    def path(self, key):
+        return os.path.join(self.root, *key[len(self.prefix):].split('/'))
+
+    def scan(self, root):
+        self.root = os.path.abspath(root)
+        # The local folders are still used for working out where subjects
+        # go, the lectures themselves are added from the bucket.
+        self.index.scan(root)
+        token = None
+        while True:
+            query = {'list-type': '2', 'prefix': self.prefix}
+            if token:
+                query['continuation-token'] = token
+            listing = self.request('GET', None, query, desc='Listing bucket')
+            for item in children(listing, 'Contents'):
+                key = child_text(item, 'Key')
+                if key.endswith('/'):
+                    continue
+                self.index.add(self.path(key), int(child_text(item, 'Size')),
+                               parse_timestamp(child_text(item, 'LastModified')))
+            token = child_text(listing, 'NextContinuationToken')
+            if child_text(listing, 'IsTruncated') != 'true' or not token:
+                break
+
+    def part(self, path, start):
+        return S3Upload(self, path)
+
+    def refresh(self, path):
+        try:
+            response = self.request('HEAD', self.key(path), desc='Checking '
+                                    + os.path.basename(path), raw=True)
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+            self.index.refresh(path)
+        else:
+            self.index.add(path, int(response.headers['Content-Length']),
+                           time.time())
+
+    def move(self, old_path, new_path):
+        source = urllib.parse.quote(f'/{self.bucket}/{self.key(old_path)}')
+        result = self.request('PUT', self.key(new_path),
+                              headers={'x-amz-copy-source': source},
+                              desc='Renaming ' + os.path.basename(old_path))
+        # Copies can fail after they've been accepted.
+        if result.tag.endswith('Error'):
+            raise StorageError(f'Couldn\'t copy {old_path}: '
+                               f'{child_text(result, "Message")}')
+        self.remove(old_path)
+        self.refresh(new_path)
+
+    def remove(self, path):
+        self.request('DELETE', self.key(path),
+                     desc='Deleting ' + os.path.basename(path))
+        self.index.refresh(path)
+
+    def request(self, method, key, query=None, data=None, headers=None,
+                desc='Talking to storage', raw=False):
+        ''' Makes a signed request for key (or the bucket, if key is None),
+        returning the XML response, or the response itself if raw.
+        '''
+        def send():
+            req = self._signed_request(method, key, query or {}, data,
+                                       headers or {})
+            with urllib.request.urlopen(req, timeout=STORAGE_TIMEOUT) as f:
+                body = f.read()
+            if raw:
+                return f
+            return parse_xml(body)
+
+        if self.retry is None:
+            return send()
+        return self.retry.call(send, desc, host=self.host,
+                               exceptions=(OSError, http.client.HTTPException),
+                               giveup=self.giveup)
+
+    def _signed_request(self, method, key, query, data, headers):
+        # AWS Signature Version 4. The payload isn't hashed, that would cost
+        # more CPU than the upload itself on a slow machine.
+        path = '/' + self.bucket
+        if key is not None:
+            path += '/' + urllib.parse.quote(key, safe='/~')
+        query = '&'.join(f'{urllib.parse.quote(k, safe="~")}='
+                         f'{urllib.parse.quote(v, safe="~")}'
+                         for k, v in sorted(query.items()))
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        headers = {k.lower(): v for k, v in headers.items()}
+        headers.update({'host': self.host, 'x-amz-date': amz_date,
+                        'x-amz-content-sha256': 'UNSIGNED-PAYLOAD'})
+        signed_headers = ';'.join(sorted(headers))
+        canonical = '\n'.join([
+            method, path, query,
+            ''.join(f'{k}:{headers[k].strip()}\n' for k in sorted(headers)),
+            signed_headers, 'UNSIGNED-PAYLOAD'])
+        to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope,
+            hashlib.sha256(canonical.encode()).hexdigest()])
+        signing_key = ('AWS4' + (self.secret_key or '')).encode()
+        for part in (amz_date[:8], self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode(),
+                                   hashlib.sha256).digest()
+        signature = hmac.new(signing_key, to_sign.encode(),
+                             hashlib.sha256).hexdigest()
+        headers['authorization'] = (
+            f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+            f'SignedHeaders={signed_headers}, Signature={signature}')
+        url = self.endpoint + path + ('?' + query if query else '')
+        return urllib.request.Request(url, data=data, headers=headers,
+                                      method=method)
+
+
+class S3Upload(object):
+    ''' A download being streamed into a multipart upload. It works like
+    util.PartFile: written is how far we've got, so a download that drops
+    out can carry on from there. Each part_size bytes are uploaded as they
+    come in, and the upload is completed by finish(), before which nothing
+    shows up in the bucket. abort() throws away what has been uploaded.
+    '''
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.key = storage.key(path)
+        self.upload_id = None
+        # (part number, ETag) of each part uploaded so far.
+        self.parts = []
+        self.uploaded = 0
+        self.buffer = bytearray()
+        self.written = 0
+
+    def open(self, start, total):
+        if start < self.uploaded:
+            # The server is sending it all again, so we have to start over.
+            if start != 0:
+                raise StorageError(f'Can\'t go back to byte {start} of an '
+                                   f'upload')
+            self.abort()
+        # Anything past start is coming again.
+        del self.buffer[start - self.uploaded:]
+        self.written = start
+        if self.upload_id is None:
+            result = self.storage.request('POST', self.key, {'uploads': ''},
+                                          desc='Starting upload')
+            self.upload_id = child_text(result, 'UploadId')
+        return self
+
+    def write(self, chunk):
+        self.buffer += chunk
+        self.written += len(chunk)
+        if len(self.buffer) >= self.storage.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        number = len(self.parts) + 1
+        data = bytes(self.buffer)
+        response = self.storage.request(
+            'PUT', self.key, {'partNumber': str(number),
+                              'uploadId': self.upload_id},
+            data=data, desc=f'Uploading part {number}', raw=True)
+        self.parts.append((number, response.headers['ETag']))
+        self.uploaded += len(data)
+        # Only let go of the data once it's safely uploaded.
+        self.buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def finish(self):
+        if self.buffer or not self.parts:
+            self._upload_part()
+        body = ''.join(f'<Part><PartNumber>{number}</PartNumber>'
+                       f'<ETag>{etag}</ETag></Part>'
+                       for number, etag in self.parts)
+        result = self.storage.request(
+            'POST', self.key, {'uploadId': self.upload_id},
+            data=f'<CompleteMultipartUpload>{body}'
+                 f'</CompleteMultipartUpload>'.encode(),
+            desc='Finishing upload')
+        # Completing can fail after it's been accepted.
+        if result.tag.endswith('Error'):
+            raise StorageError(f'Couldn\'t finish uploading {self.path}: '
+                               f'{child_text(result, "Message")}')
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.storage.request('DELETE', self.key,
+                                 {'uploadId': self.upload_id},
+                                 desc='Cancelling upload')
+        self.upload_id = None
+        self.parts = []
+        self.uploaded = self.written = 0
+        self.buffer = bytearray()
+
+
+def parse_xml(body):
+    # xml is only needed for S3, so it's only imported for it.
+    import xml.etree.ElementTree as ElementTree
+    if not body.strip():
+        return ElementTree.Element('Empty')
+    return ElementTree.fromstring(body)
+
+
+def children(element, name):
+    # S3 puts everything in a namespace, which we don't care about.
+    return [child for child in element
+            if child.tag.rsplit('}', 1)[-1] == name]
+
+
+def child_text(element, name):
+    for child in children(element, name):
+        return child.text
+    return None
+
+
+def parse_timestamp(text):
+    # e.g. 2017-10-07T05:12:44.000Z
+    with suppress(TypeError, ValueError):
+        return calendar.timegm(time.strptime(text[:19], '%Y-%m-%dT%H:%M:%S'))
+    return None
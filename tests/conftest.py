@@ -0,0 +1,5 @@
+import os
+import sys
+
+# lectureDL is a script rather than a package, so make it importable.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,17 @@
+import datetime
+
+from lectureDL import parse_recording_date
+
+
+def test_recording_date_formats():
+    assert parse_recording_date('August 02 3:20 PM', 2017) == \
+        datetime.datetime(2017, 8, 2)
+    assert parse_recording_date('02 August 3:20 PM', 2017) == \
+        datetime.datetime(2017, 8, 2)
+
+
+def test_leap_day_goes_back_to_a_leap_year():
+    assert parse_recording_date('February 29 3:20 PM', 2026) == \
+        datetime.datetime(2024, 2, 29)
+    assert parse_recording_date('February 29 3:20 PM', 2024) == \
+        datetime.datetime(2024, 2, 29)
@@ -0,0 +1,24 @@
+import datetime
+
+import lectureDL
+from lectureDL import Lecture
+from manifest import Manifest
+from runlog import RunLog
+from scheduler import DownloadScheduler
+
+
+def test_manifest_save_failing_doesnt_stop_downloads(tmp_path, monkeypatch):
+    manifest = Manifest()
+    # Somewhere it can't be written.
+    manifest.path = str(tmp_path / 'missing' / 'manifest.json')
+    monkeypatch.setattr(lectureDL, 'manifest', manifest)
+    log = RunLog(str(tmp_path / 'run.jsonl'))
+    q = DownloadScheduler()
+    for link in ('a', 'b'):
+        lec = Lecture(link, 'COMP1', 1, 1, datetime.datetime(2017, 8, 2),
+                      'Comp', 1, 'COMP1 - Comp', fName=link)
+        q.put(lambda: None, lec)
+    q.close()
+    lectureDL.consume_dl_queue(q, log)
+    assert log.counts['downloaded'] == 2
+    assert manifest.get('b')['downloaded']
@@ -0,0 +1,24 @@
+import time
+
+import hooks
+from hooks import HookDispatcher, run_command
+
+
+def test_hung_command_is_stopped(monkeypatch):
+    monkeypatch.setattr(hooks, 'COMMAND_TIMEOUT', 0.2)
+    start = time.monotonic()
+    try:
+        run_command('sleep 5; sleep 5', 'downloaded', {'name': 'a'})
+    except RuntimeError as e:
+        assert 'longer' in str(e)
+    else:
+        assert False, 'should have timed out'
+    assert time.monotonic() - start < 2
+
+
+def test_close_gives_up_on_a_hung_hook():
+    dispatcher = HookDispatcher([lambda event, entry: time.sleep(5)])
+    dispatcher.fire('downloaded', {'name': 'a'})
+    start = time.monotonic()
+    dispatcher.close(timeout=0.2)
+    assert time.monotonic() - start < 1
@@ -0,0 +1,46 @@
+import datetime
+
+import lectureDL
+from lectureDL import Lecture, number_week
+
+
+def lecture(link):
+    return Lecture(link, 'COMP1', 1, None, datetime.datetime(2017, 8, 2),
+                   'Comp', 1, 'COMP1 - Comp')
+
+
+def test_number_week_counts_recordings_without_links():
+    # Newest first, and the middle one's link couldn't be read.
+    week = [lecture('c'), lecture(None), lecture('a')]
+    numbered = list(number_week(week))
+    assert [(lec.link, lec.lecOfWeek) for lec in numbered] == [('c', 3),
+                                                               ('a', 1)]
+
+
+class FakeDriver(object):
+    ''' Reads every recording's link straight away, keeping track of which
+    it was asked for.
+    '''
+
+    def __init__(self):
+        self.batches = []
+
+    def set_script_timeout(self, seconds):
+        pass
+
+    def execute_async_script(self, script, rec_nums, *args):
+        self.batches.append(list(rec_nums))
+        return {str(rec_num): f'page{rec_num}' for rec_num in rec_nums}
+
+
+def test_first_links_are_read_in_batches(monkeypatch):
+    monkeypatch.setattr(lectureDL, 'BULK_LINK_BATCH', 2)
+    driver = FakeDriver()
+    links = lectureDL.find_first_links(driver, None, [None] * 5,
+                                       [0, 1, 2, 3, 4], 'video')
+    # The first batch is ready before the next one is read.
+    assert next(links) == (0, 'page0')
+    assert driver.batches == [[0, 1]]
+    assert list(links) == [(1, 'page1'), (2, 'page2'), (3, 'page3'),
+                           (4, 'page4')]
+    assert driver.batches == [[0, 1], [2, 3], [4]]
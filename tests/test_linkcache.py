@@ -0,0 +1,66 @@
+import http.server
+import threading
+import urllib.request
+
+import pytest
+
+from linkcache import LinkCache
+from manifest import Manifest
+from util import cookie_jar
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.cookies.append(self.headers.get('Cookie'))
+        body = b'<a href="/media/1.m4v?Expires=4102444800">Download media file.'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    server.cookies = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+COOKIES = [
+    {'name': 'session', 'value': 'abc', 'domain': '127.0.0.1', 'path': '/'},
+    {'name': 'lecture', 'value': '1', 'domain': '127.0.0.1',
+     'path': '/lectures'},
+    {'name': 'elsewhere', 'value': 'x', 'domain': '.example.com', 'path': '/'},
+]
+
+
+def test_refresh_sends_cookies_for_the_page_only(server):
+    cache = LinkCache(Manifest())
+    cache.cookies = COOKIES
+    page = f'http://127.0.0.1:{server.server_port}/lectures/1'
+    url = cache.refresh(page)
+    assert url == (f'http://127.0.0.1:{server.server_port}'
+                   f'/media/1.m4v?Expires=4102444800')
+    assert cache.get(page) == url
+    assert server.cookies == ['lecture=1; session=abc']
+
+
+def test_cookie_jar_keeps_cookies_to_their_hosts(server):
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(cookie_jar(COOKIES)))
+    opener.open(f'http://127.0.0.1:{server.server_port}/media/1').close()
+    opener.open(f'http://localhost:{server.server_port}/media/1').close()
+    assert server.cookies == ['session=abc', None]
+
+
+def test_cookie_jar_dotless_hosts():
+    jar = cookie_jar([{'name': 'a', 'value': '1', 'domain': 'localhost'}])
+    req = urllib.request.Request('http://localhost/')
+    jar.add_cookie_header(req)
+    assert req.get_header('Cookie') == 'a=1'
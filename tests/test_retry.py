@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from util import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+def failing():
+    raise ConnectionError('nope')
+
+
+def test_one_call_retrying_doesnt_open_the_circuit():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    retry = RetryPolicy(max_retries=5, base_delay=0, breaker=breaker)
+    with pytest.raises(ConnectionError):
+        retry.call(failing, 'Failing', host='media')
+    # The next lecture still gets to try.
+    assert retry.call(lambda: 'ok', 'Working', host='media') == 'ok'
+
+
+def test_open_circuit_is_waited_out():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.2)
+    retry = RetryPolicy(max_retries=0, base_delay=0, breaker=breaker)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            retry.call(failing, 'Failing', host='media')
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call('media')
+    start = time.monotonic()
+    assert retry.call(lambda: 'ok', 'Working', host='media') == 'ok'
+    assert time.monotonic() - start >= 0.1
+
+
+def test_still_failing_after_the_wait():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    retry = RetryPolicy(max_retries=5, base_delay=0, breaker=breaker)
+    with pytest.raises(ConnectionError):
+        RetryPolicy(max_retries=0, breaker=breaker).call(failing, 'Failing',
+                                                         host='media')
+    # Waits once, the trial fails and opens it again, so it gives up.
+    with pytest.raises(CircuitOpenError):
+        retry.call(failing, 'Failing', host='media')
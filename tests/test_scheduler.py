@@ -0,0 +1,47 @@
+import datetime
+import time
+
+from types import SimpleNamespace
+
+from scheduler import DiskSpaceAdmission, DownloadScheduler
+
+
+def lecture(name):
+    return SimpleNamespace(fName=name, fPath=name, subjCode='COMP1',
+                           date=datetime.datetime(2017, 8, 2))
+
+
+class NoSpace(object):
+    def admit(self, job):
+        return False
+
+    def release(self, job):
+        pass
+
+
+def test_disk_space_wait_is_shared():
+    q = DownloadScheduler(admission=NoSpace(), max_wait=0.2)
+    q.ADMISSION_POLL = 0.01
+    for name in 'abc':
+        q.put(None, lecture(name), 100)
+    q.close()
+    start = time.monotonic()
+    jobs = [q.get() for _ in range(3)]
+    # Only the first job waits, the rest are turned away straight after.
+    assert time.monotonic() - start < 0.4
+    assert all(job.rejected for job in jobs)
+    assert q.get() is None
+
+
+def test_preallocated_space_isnt_counted_twice(tmp_path):
+    admission = DiskSpaceAdmission(str(tmp_path))
+    q = DownloadScheduler(admission=admission)
+    job = q.put(None, lecture(str(tmp_path / 'a.m4v')), 1024 * 1024)
+    assert q.get() is job
+    assert admission.promised() == 1024 * 1024
+    # The download reserves its space on disk, so it isn't promised any more.
+    with open(job.lecture.fPath + '.part', 'wb') as f:
+        f.write(bytes(1024 * 1024))
+    assert admission.promised() == 0
+    q.done(job)
+    assert admission.promised() == 0
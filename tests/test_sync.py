@@ -0,0 +1,207 @@
+import http.server
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+import lectureDL
+from fileindex import FileIndex
+from naming import NameTemplate
+from storage import LocalStorage
+
+
+@pytest.fixture
+def uni(tmp_path, monkeypatch):
+    ''' An empty uni folder for sync to work on, with lectureDL's globals
+    pointed at it.
+    '''
+    index = FileIndex()
+    monkeypatch.setattr(lectureDL, 'file_index', index)
+    monkeypatch.setattr(lectureDL, 'storage', LocalStorage(index, False))
+    monkeypatch.setitem(lectureDL.settings, 'uni_location', str(tmp_path))
+    monkeypatch.setitem(lectureDL.settings, 'run_log',
+                        str(tmp_path / 'run.jsonl'))
+    # setup_uni_folder replaces stdout, this puts it back afterwards.
+    monkeypatch.setattr(sys, 'stdout', sys.stdout)
+    return tmp_path
+
+
+def add_lecture(uni, link, name, contents=b'lecture', **fields):
+    ''' Saves a lecture called name (a path under the subject's lecture
+    folder) and a manifest entry for it. Returns its path.
+    '''
+    path = os.path.join(str(uni), 'COMP1 - Comp', 'Lectures', name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(contents)
+    entry = dict(subject='COMP1', subject_name='Comp', date='2020-03-02',
+                 week=1, lecture=1, recording=1, period='2020 SM1',
+                 name=os.path.basename(name)[:-4], path=path, media='video',
+                 size=len(contents), url='http://media/' + link)
+    entry.update(fields)
+    manifest_path = os.path.join(str(uni), '.lectureDL_manifest.json')
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            entries = json.load(f)
+    entries[link] = entry
+    with open(manifest_path, 'w') as f:
+        json.dump(entries, f)
+    return path
+
+
+def manifest_entries(uni):
+    with open(os.path.join(str(uni), '.lectureDL_manifest.json')) as f:
+        return json.load(f)
+
+
+def test_lectures_stay_put_when_their_period_ends(uni):
+    # Saved under the current template back when 2020 SM1 was current.
+    path = add_lecture(uni, 'pageA', 'COMP1 Week 01 Lecture 1.m4v')
+    lectureDL.sync()
+    assert os.path.isfile(path)
+    assert manifest_entries(uni)['pageA']['path'] == path
+    assert manifest_entries(uni)['pageA']['layout'] == 'current'
+
+
+def test_lectures_follow_their_template(uni, monkeypatch):
+    path = add_lecture(uni, 'pageA', 'COMP1 Week 01 Lecture 1.m4v',
+                       layout='current')
+    monkeypatch.setattr(lectureDL, 'LECTURE_NAME',
+                        NameTemplate('{code} L{recording}'))
+    lectureDL.sync()
+    new_path = os.path.join(os.path.dirname(path), 'COMP1 L1.m4v')
+    assert not os.path.exists(path)
+    assert os.path.isfile(new_path)
+    assert manifest_entries(uni)['pageA']['path'] == new_path
+
+
+def test_rename_onto_existing_file_leaves_both(uni, monkeypatch):
+    path = add_lecture(uni, 'pageA', 'COMP1 Week 01 Lecture 1.m4v',
+                       layout='current')
+    # Something we don't know about is already where it's meant to go.
+    other = os.path.join(os.path.dirname(path), 'COMP1 L1.m4v')
+    with open(other, 'wb') as f:
+        f.write(b'other')
+    monkeypatch.setattr(lectureDL, 'LECTURE_NAME',
+                        NameTemplate('{code} L{recording}'))
+    lectureDL.sync()
+    assert manifest_entries(uni)['pageA']['path'] == path
+    with open(path, 'rb') as f:
+        assert f.read() == b'lecture'
+    with open(other, 'rb') as f:
+        assert f.read() == b'other'
+
+
+def test_missing_lectures_are_downloaded(uni):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '7')
+            self.end_headers()
+            self.wfile.write(b'lecture')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        path = add_lecture(uni, 'pageA', 'COMP1 Week 01 Lecture 1.m4v',
+                           layout='current',
+                           url=f'http://127.0.0.1:{server.server_port}/1',
+                           url_expires=4102444800)
+        os.remove(path)
+        lectureDL.sync()
+    finally:
+        server.shutdown()
+        server.server_close()
+    with open(path, 'rb') as f:
+        assert f.read() == b'lecture'
+    assert manifest_entries(uni)['pageA']['path'] == path
+
+
+def test_crawl_rename_onto_another_lecture_keeps_both(uni, monkeypatch):
+    path_a = add_lecture(uni, 'pageA', 'COMP1 Week 01 Lecture 1.m4v',
+                         contents=b'lecture A', layout='current')
+    path_b = add_lecture(uni, 'pageB', 'COMP1 Week 01 Lecture 2.m4v',
+                         contents=b'lecture B', layout='current', lecture=2,
+                         recording=2)
+    monkeypatch.setattr(lectureDL, 'LECTURE_NAME',
+                        NameTemplate('{code} Week {week:02}'))
+    uni_folder = lectureDL.setup_uni_folder()
+    log = lectureDL.RunLog(str(uni / 'run.jsonl'))
+    for link in ('pageB', 'pageA'):
+        lec = lectureDL.lecture_from_entry(
+            link, lectureDL.manifest.get(link), uni_folder)
+        lec = lectureDL.assign_filepath(lec, 'video', uni_folder)
+        lec = lectureDL.follow_rename(lec, log)
+        lectureDL.remember_lecture(lec)
+    new_path = os.path.join(os.path.dirname(path_a), 'COMP1 Week 01.m4v')
+    assert lectureDL.manifest.get('pageB')['path'] == new_path
+    assert lectureDL.manifest.get('pageA')['path'] == path_a
+    with open(new_path, 'rb') as f:
+        assert f.read() == b'lecture B'
+    with open(path_a, 'rb') as f:
+        assert f.read() == b'lecture A'
+
+
+class MediaServer(http.server.BaseHTTPRequestHandler):
+    ''' /page gives the media link to whoever has the session cookie, /old
+    has expired, /new is the lecture and anything else isn't there.
+    '''
+
+    def do_GET(self):
+        if self.path == '/page':
+            if self.headers.get('Cookie') == 'session=abc':
+                body = b'<a href="/new">Download media file.</a>'
+            else:
+                body = b'Please log in'
+            self.reply(200, body)
+        elif self.path == '/old':
+            self.reply(403, b'')
+        elif self.path == '/new':
+            self.reply(200, b'lecture')
+        else:
+            self.reply(404, b'')
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_sync_refreshes_links_with_the_saved_session(uni, monkeypatch,
+                                                     capsys):
+    server = http.server.HTTPServer(('127.0.0.1', 0), MediaServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    session_file = str(uni / 'session.json')
+    lectureDL.save_cookies(session_file, [
+        {'name': 'session', 'value': 'abc', 'domain': '127.0.0.1',
+         'path': '/'}])
+    monkeypatch.setitem(lectureDL.settings, 'session_file', session_file)
+    monkeypatch.setattr(lectureDL.link_cache, 'cookies', None)
+    try:
+        expired = add_lecture(uni, base + '/page',
+                              'COMP1 Week 01 Lecture 1.m4v', layout='current',
+                              url=base + '/old', url_expires=4102444800)
+        gone = add_lecture(uni, base + '/gone', 'COMP1 Week 01 Lecture 2.m4v',
+                           layout='current', lecture=2, recording=2,
+                           url=base + '/missing', url_expires=4102444800)
+        os.remove(expired)
+        os.remove(gone)
+        lectureDL.sync()
+    finally:
+        server.shutdown()
+        server.server_close()
+    with open(expired, 'rb') as f:
+        assert f.read() == b'lecture'
+    assert not os.path.exists(gone)
+    assert '1 downloaded, 1 failed' in capsys.readouterr().out
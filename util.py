@@ -1,9 +1,16 @@
 import inspect
 import io
+import json
+import os
+import random
 import shutil
 import sys
+import threading
 import time
 
+from collections import defaultdict
+from contextlib import suppress
+
 def retry_until_result(wait_message, delay=0.25, max_retries=20):
     ''' Decorator to retry a function until it doesn't return None.
     As such it obviously relies on the function returning None on failure.
@@ -36,6 +43,258 @@ def retry_until_result(wait_message, delay=0.25, max_retries=20):
     return actual_decorator
 
 
+class CircuitOpenError(RuntimeError):
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        # Seconds until the host will be tried again.
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    ''' Tracks consecutive failures per host. Once a host has failed
+    threshold times in a row the circuit opens, and calls to that host fail
+    straight away with CircuitOpenError until cooldown seconds have passed.
+    After that a single trial call is let through, if it fails the circuit
+    opens again. RetryPolicy counts each call it makes as one failure, however
+    many times it's retried, so one bad request can't open the circuit alone.
+    '''
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = defaultdict(int)
+        self._opened_at = {}
+        self._lock = threading.Lock()
+
+    def before_call(self, host):
+        with self._lock:
+            opened_at = self._opened_at.get(host)
+            if opened_at is None:
+                return
+            waited = time.monotonic() - opened_at
+            if waited < self.cooldown:
+                raise CircuitOpenError(f'{host} is failing, not trying it '
+                                       f'again for a while.',
+                                       self.cooldown - waited)
+            # Half open, one more failure will open the circuit again.
+            del self._opened_at[host]
+            self._failures[host] = self.threshold - 1
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures[host] = 0
+            self._opened_at.pop(host, None)
+
+    def record_failure(self, host):
+        with self._lock:
+            self._failures[host] += 1
+            if self._failures[host] >= self.threshold:
+                self._opened_at[host] = time.monotonic()
+
+
+class RetryPolicy(object):
+    ''' Retries a function that raises, with exponential backoff and full
+    jitter between attempts, up to max_retries times before re-raising the
+    last exception. If a host and a CircuitBreaker are given, failures count
+    against that host, and a call to a host with an open circuit waits for it
+    to be given another go (once, after that it fails straight away).
+    '''
+
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=30,
+                 breaker=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def call(self, function, description, exceptions=(Exception,),
+             host=None, giveup=None):
+        ''' Calls function() until it returns. Exceptions not in exceptions,
+        or for which giveup(e) is True, are raised straight away.
+        '''
+        breaker = self.breaker if host else None
+        attempt = 0
+        counted = waited = False
+        while True:
+            if breaker:
+                try:
+                    breaker.before_call(host)
+                except CircuitOpenError as e:
+                    # Other requests to the host have been failing, give it
+                    # the cooldown rather than failing this one for them.
+                    if waited:
+                        raise
+                    waited = True
+                    print(f'{description} is waiting {e.retry_after:.0f}s, '
+                          f'{host} has been failing')
+                    time.sleep(e.retry_after)
+                    # If the host is still failing, it needs to hear so.
+                    counted = False
+                    continue
+            try:
+                result = function()
+            except CircuitOpenError:
+                raise
+            except exceptions as e:
+                if giveup and giveup(e):
+                    raise
+                # Retries of the same call only count once.
+                if breaker and not counted:
+                    breaker.record_failure(host)
+                    counted = True
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.delay(attempt)
+                attempt += 1
+                print(f'{description} failed ({e}), retry {attempt} of '
+                      f'{self.max_retries} in {delay:.1f}s')
+                time.sleep(delay)
+            else:
+                if breaker:
+                    breaker.record_success(host)
+                return result
+
+
+def write_private_json(path, data):
+    ''' Writes data to path as JSON, readable only by the current user. For
+    anything holding a live session, like cookies.
+    '''
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with open(fd, 'w') as f:
+        json.dump(data, f, indent=1)
+    # The file might have already existed with looser permissions.
+    os.chmod(path, 0o600)
+
+
+def save_cookies(path, cookies):
+    ''' Saves a list of cookie dicts (as given by driver.get_cookies()) to
+    path, readable only by the current user since they hold a live session.
+    '''
+    write_private_json(path, cookies)
+
+
+def load_cookies(path):
+    ''' Loads cookies saved with save_cookies, leaving out any that have
+    expired. Returns an empty list if there is nothing usable.
+    '''
+    try:
+        with open(path) as f:
+            cookies = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return drop_expired_cookies(cookies)
+
+
+def drop_expired_cookies(cookies):
+    now = time.time()
+    return [c for c in cookies if c.get('expiry') is None or c['expiry'] > now]
+
+
+def cookie_jar(cookies):
+    ''' Turns a list of cookie dicts into a CookieJar, so that each cookie is
+    only sent to the domain and path it came from, not everywhere.
+    '''
+    import http.cookiejar
+    jar = http.cookiejar.CookieJar()
+    for c in cookies:
+        domain = c.get('domain') or ''
+        # CookieJar knows hosts without a dot in them (like localhost) by
+        # that name with .local on the end.
+        if domain and '.' not in domain.strip('.'):
+            domain += '.local'
+        jar.set_cookie(http.cookiejar.Cookie(
+            version=0, name=c['name'], value=c['value'], port=None,
+            port_specified=False, domain=domain,
+            domain_specified=domain.startswith('.'),
+            domain_initial_dot=domain.startswith('.'),
+            path=c.get('path') or '/', path_specified=True,
+            secure=bool(c.get('secure')), expires=c.get('expiry'),
+            discard=c.get('expiry') is None, comment=None, comment_url=None,
+            rest={}))
+    return jar
+
+
+class PartFile(object):
+    ''' A download in progress, written to <path>.part. The part file is
+    preallocated to its full size up front so it doesn't get fragmented as it
+    grows, which means its size no longer says how far we got. Instead that
+    is checkpointed to <path>.part.json every so often, and the part file is
+    only renamed to path once it's complete. Use like:
+    with part.open(start, total) as output:
+        output.write(chunk)
+    part.finish()
+    '''
+
+    CHECKPOINT_EVERY = 8 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.part_path = path + '.part'
+        self.progress_path = path + '.part.json'
+        self.file = None
+        # How many bytes are safely in the part file.
+        self.written = self._load_progress()
+        self._checkpointed = self.written
+
+    @staticmethod
+    def supported():
+        return hasattr(os, 'posix_fallocate')
+
+    def _load_progress(self):
+        # Anything written after the last checkpoint just gets downloaded again.
+        if not os.path.isfile(self.part_path):
+            return 0
+        try:
+            with open(self.progress_path) as f:
+                return int(json.load(f)['written'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0
+
+    def open(self, start, total):
+        mode = 'r+b' if os.path.isfile(self.part_path) else 'wb'
+        self.file = open(self.part_path, mode)
+        # Not every filesystem supports this, in which case it just grows.
+        with suppress(OSError):
+            os.posix_fallocate(self.file.fileno(), 0, total)
+        self.file.seek(start)
+        self.written = self._checkpointed = start
+        return self
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.written += len(chunk)
+        if self.written - self._checkpointed >= self.CHECKPOINT_EVERY:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # The data has to be on disk before we say it is.
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        with open(self.progress_path, 'w') as f:
+            json.dump({'written': self.written}, f)
+        self._checkpointed = self.written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.checkpoint()
+        self.file.close()
+
+    def finish(self):
+        os.replace(self.part_path, self.path)
+        with suppress(OSError):
+            os.remove(self.progress_path)
+
+    def abort(self):
+        # The part file is kept so that the next run can pick up from it.
+        pass
+
+
 def show_progress(filehook, pretty_name, localSize, webSize, chunk_size=1024):
     ''' Downloads a file, optionally partially, while showing the progress of
     the download. This download progress is printed on the same line using a